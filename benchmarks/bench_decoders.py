@@ -0,0 +1,466 @@
+#!/usr/bin/env python
+"""
+Decoder benchmark per encoding.
+
+Encodes a synthetic desktop (windows, text and a photo) with each encoding and
+feeds the updates through RFBToGUI.dataReceived into a headless ArrayBuffer.
+Captured sessions (Client(capture=...)) can be measured as well. Reports MB/s,
+rectangles/s and frames/s per encoding and screen size, writes the results as
+JSON and compares them with a previous run.
+
+usage: python benchmarks/bench_decoders.py [--sizes 1024x768,1920x1080] [--encodings raw,tight]
+                                           [--capture session.cap] [--output now.json] [--compare before.json]
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import struct
+import sys
+import time
+import zlib
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import numpy as np
+import pygame
+from pyVNC import rfb
+from pyVNC.Buffer import ArrayBuffer
+from pyVNC.RFBToGUI import RFBToGUI
+from pyVNC.VNCFactory import VNCFactory
+from pyVNC.ReplayServer import capture_chunks
+
+PIXEL_FORMAT = struct.pack("!BBBBHHHBBBxxx", 32, 24, 0, 1, 255, 255, 255, 0, 8, 16)
+
+
+class NullTransport:
+    def write(self, data):
+        pass
+
+    def writeSequence(self, data):
+        pass
+
+    def loseConnection(self):
+        pass
+
+
+class BenchClient(RFBToGUI):
+    """RFBToGUI that counts the updates and rectangles it decoded"""
+
+    def __init__(self):
+        super().__init__()
+        self.frames = 0
+        self.rectangle_count = 0
+
+    def commit_update(self, rectangles=None):
+        self.frames += 1
+        self.rectangle_count += len(rectangles)
+        super().commit_update(rectangles)
+
+
+def connect(server_init=None, width=0, height=0, native_format=False):
+    """a BenchClient after the handshake, server_init defaults to a 32 bit RGBX screen of width x height"""
+    factory = VNCFactory(ArrayBuffer(), 32, False, None, 1, native_format=native_format)
+    protocol = BenchClient()
+    protocol.factory = factory
+    protocol.makeConnection(NullTransport())
+    protocol.dataReceived(b"RFB 003.003\n")
+    protocol.dataReceived(struct.pack("!I", 1))
+    if server_init is None:
+        server_init = struct.pack("!HH16sI", width, height, PIXEL_FORMAT, 5) + b"bench"
+    protocol.dataReceived(server_init)
+    return protocol
+
+
+# --- synthetic screen
+
+def desktop(width, height, seed=0):
+    """RGBX screen with flat windows, lines of text and a photo"""
+    rng = np.random.default_rng(seed)
+    image = np.zeros(shape=(height, width, 4), dtype=np.uint8)
+    image[..., :3] = (58, 110, 165)
+    for _ in range(8):
+        w, h = int(rng.integers(width // 6, width // 2)), int(rng.integers(height // 6, height // 2))
+        x, y = int(rng.integers(0, width - w)), int(rng.integers(0, height - h))
+        image[y:y + h, x:x + w, :3] = rng.integers(180, 255, 3)
+        image[y:y + 20, x:x + w, :3] = rng.integers(0, 120, 3)  # title bar
+        for line in range(y + 28, y + h - 12, 16):  # text: dark glyph strokes on the window color
+            strokes = rng.random((9, w - 16)) < 0.3
+            strokes[:, rng.random(w - 16) < 0.25] = False
+            image[line:line + 9, x + 8:x + w - 8][strokes] = (20, 20, 20, 0)
+    w, h = width // 4, height // 4
+    x, y = width - w - 10, height - h - 10
+    gy, gx = np.mgrid[0:h, 0:w]
+    photo = np.stack([gx * 255 // w, gy * 255 // h, (gx + gy) * 127 // (w + h)], axis=2)
+    image[y:y + h, x:x + w, :3] = np.minimum(photo + rng.integers(0, 24, (h, w, 3)), 255)
+    return image
+
+
+def header(x, y, width, height, encoding):
+    return struct.pack("!HHHHi", x, y, width, height, encoding)
+
+
+def update(rectangles):
+    return struct.pack("!BxH", 0, len(rectangles)) + b"".join(rectangles)
+
+
+def tiles(width, height, size):
+    for y in range(0, height, size):
+        for x in range(0, width, size):
+            yield x, y, min(size, width - x), min(size, height - y)
+
+
+def runs(image):
+    """(x, y, width, height, color) rectangles of the pixels that differ from the most common color,
+       horizontal runs of one color merged with equal runs in the rows below"""
+    values = np.ascontiguousarray(image).view(np.uint32)[..., 0]
+    colors, counts = np.unique(values, return_counts=True)
+    bg = colors[counts.argmax()]
+    rectangles = []
+    open_runs = {}  # (x, width, color) -> index of the rectangle that reached the previous row
+    for y, row in enumerate(values):
+        starts = np.flatnonzero(np.diff(row, prepend=row[0] ^ 1))
+        lengths = np.diff(np.append(starts, len(row)))
+        current = {}
+        for x, length, color in zip(starts.tolist(), lengths.tolist(), row[starts].tolist()):
+            if color == bg:
+                continue
+            key = (x, length, color)
+            index = open_runs.get(key)
+            if index is None:
+                index = len(rectangles)
+                rectangles.append([x, y, length, 0, color])
+            rectangles[index][3] += 1
+            current[key] = index
+        open_runs = current
+    return bg, rectangles
+
+
+def color_bytes(color):
+    return struct.pack("<I", color)
+
+
+def pack_bits(indices, bits):
+    """rows of palette indices packed most significant bits first, rows padded to whole bytes"""
+    per_byte = 8 // bits
+    height, width = indices.shape
+    padded = np.zeros(shape=(height, -(-width // per_byte) * per_byte), dtype=np.uint8)
+    padded[:, :width] = indices
+    shifts = (bits * np.arange(per_byte - 1, -1, -1)).astype(np.uint8)
+    return np.bitwise_or.reduce(padded.reshape(height, -1, per_byte) << shifts, axis=2).astype(np.uint8).tobytes()
+
+
+def palette_of(tile, limit):
+    """(colors, indices) of a tile with at most limit colors, otherwise None"""
+    values = np.ascontiguousarray(tile).view(np.uint32)[..., 0]
+    colors, indices = np.unique(values, return_inverse=True)
+    if len(colors) > limit:
+        return None
+    return colors, indices.reshape(values.shape).astype(np.uint8)
+
+
+# --- encoders, each returns a function that encodes one update of the image,
+#     lossy encoders replace the image with the pixels the client decodes
+
+def raw_encoder(image):
+    height, width = image.shape[:2]
+    return lambda: [header(0, 0, width, height, rfb.RAW_ENCODING) + image.tobytes()]
+
+
+def copyrect_encoder(image):
+    """scroll the screen by 16 rows and send the new rows raw"""
+    height, width = image.shape[:2]
+    return lambda: [header(0, 0, width, height - 16, rfb.COPY_RECTANGLE_ENCODING) + struct.pack("!HH", 0, 16),
+                    header(0, height - 16, width, 16, rfb.RAW_ENCODING) + image[height - 16:].tobytes()]
+
+
+def rre_encoder(image):
+    height, width = image.shape[:2]
+    bg, subrects = runs(image)
+    body = b"".join(color_bytes(color) + struct.pack("!HHHH", x, y, w, h) for x, y, w, h, color in subrects)
+    rectangle = header(0, 0, width, height, rfb.RRE_ENCODING) + struct.pack("!I", len(subrects)) + color_bytes(bg) + body
+    return lambda: [rectangle]
+
+
+def corre_encoder(image):
+    height, width = image.shape[:2]
+    rectangles = []
+    for x, y, w, h in tiles(width, height, 128):
+        bg, subrects = runs(image[y:y + h, x:x + w])
+        body = b"".join(color_bytes(color) + struct.pack("!BBBB", *r) for *r, color in subrects)
+        rectangles.append(header(x, y, w, h, rfb.CORRE_ENCODING) + struct.pack("!I", len(subrects)) + color_bytes(bg) + body)
+    return lambda: rectangles
+
+
+def hextile_tile(tile):
+    """(subencoding, body) of one hextile tile"""
+    bg, subrects = runs(tile)
+    raw = (1, tile.tobytes())
+    if not subrects:
+        return 2, color_bytes(bg)
+    colors = set(color for *_, color in subrects)
+    if len(colors) == 1:
+        encoded = (14, color_bytes(bg) + color_bytes(colors.pop()) + bytes([len(subrects)]) +
+                   b"".join(bytes([x << 4 | y, (w - 1) << 4 | (h - 1)]) for x, y, w, h, _ in subrects))
+    else:
+        encoded = (26, color_bytes(bg) + bytes([len(subrects)]) +
+                   b"".join(color_bytes(c) + bytes([x << 4 | y, (w - 1) << 4 | (h - 1)]) for x, y, w, h, c in subrects))
+    return encoded if len(subrects) < 256 and len(encoded[1]) < len(raw[1]) else raw
+
+
+def hextile_tiles(image):
+    height, width = image.shape[:2]
+    body = []
+    for x, y, w, h in tiles(width, height, 16):
+        subencoding, data = hextile_tile(image[y:y + h, x:x + w])
+        body.append(bytes([subencoding]) + data)
+    return b"".join(body)
+
+
+def hextile_encoder(image):
+    height, width = image.shape[:2]
+    rectangle = header(0, 0, width, height, rfb.HEXTILE_ENCODING) + hextile_tiles(image)
+    return lambda: [rectangle]
+
+
+def zlibhex_encoder(image):
+    """hextile tiles compressed with the two ZlibHex streams, raw tiles on the raw stream"""
+    height, width = image.shape[:2]
+    raw_stream, stream = zlib.compressobj(6), zlib.compressobj(6)
+    encoded = [hextile_tile(image[y:y + h, x:x + w]) for x, y, w, h in tiles(width, height, 16)]
+
+    def encode():
+        body = []
+        for subencoding, data in encoded:
+            if subencoding == 1:
+                subencoding, data = 32, raw_stream.compress(data) + raw_stream.flush(zlib.Z_SYNC_FLUSH)
+            else:
+                subencoding, data = subencoding | 64, stream.compress(data) + stream.flush(zlib.Z_SYNC_FLUSH)
+            body.append(bytes([subencoding]) + struct.pack("!H", len(data)) + data)
+        return [header(0, 0, width, height, rfb.ZLIBHEX_ENCODING) + b"".join(body)]
+    return encode
+
+
+def zlib_encoder(image):
+    height, width = image.shape[:2]
+    stream = zlib.compressobj(6)
+
+    def encode():
+        data = stream.compress(image.tobytes()) + stream.flush(zlib.Z_SYNC_FLUSH)
+        return [header(0, 0, width, height, rfb.ZLIB_ENCODING) + struct.pack("!I", len(data)) + data]
+    return encode
+
+
+def zrle_tiles(image):
+    height, width = image.shape[:2]
+    body = []
+    for x, y, w, h in tiles(width, height, 64):
+        tile = image[y:y + h, x:x + w]
+        found = palette_of(tile, 16)
+        if found is None:
+            body.append(b"\x00" + tile[..., :3].tobytes())
+            continue
+        colors, indices = found
+        cpixels = b"".join(color_bytes(color)[:3] for color in colors.tolist())
+        if len(colors) == 1:
+            body.append(b"\x01" + cpixels)
+        else:
+            bits = 1 if len(colors) == 2 else 2 if len(colors) <= 4 else 4
+            body.append(bytes([len(colors)]) + cpixels + pack_bits(indices, bits))
+    return b"".join(body)
+
+
+def zrle_encoder(image):
+    height, width = image.shape[:2]
+    stream = zlib.compressobj(6)
+    tiles_data = zrle_tiles(image)
+
+    def encode():
+        data = stream.compress(tiles_data) + stream.flush(zlib.Z_SYNC_FLUSH)
+        return [header(0, 0, width, height, rfb.ZRLE_ENCODING) + struct.pack("!I", len(data)) + data]
+    return encode
+
+
+def compact_length(length):
+    encoded = bytes([length & 0x7f | (0x80 if length > 0x7f else 0)])
+    if length > 0x7f:
+        encoded += bytes([length >> 7 & 0x7f | (0x80 if length > 0x3fff else 0)])
+    if length > 0x3fff:
+        encoded += bytes([length >> 14])
+    return encoded
+
+
+def gradient_encode(rgb):
+    """prediction errors of the tight gradient filter for a (height, width, 3) array"""
+    values = np.zeros(shape=(rgb.shape[0] + 1, rgb.shape[1] + 1, 3), dtype=np.int32)
+    values[1:, 1:] = rgb
+    predicted = np.clip(values[:-1, 1:] + values[1:, :-1] - values[:-1, :-1], 0, 255)
+    return ((values[1:, 1:] - predicted) & 255).astype(np.uint8)
+
+
+def jpeg(rgb):
+    """(JPEG data, decoded pixels) of a (height, width, 3) array"""
+    height, width = rgb.shape[:2]
+    out = io.BytesIO()
+    pygame.image.save(pygame.image.frombuffer(rgb.tobytes(), (width, height), "RGB"), out, "rect.jpg")
+    decoded = pygame.image.tostring(pygame.image.load(io.BytesIO(out.getvalue()), "rect.jpg"), "RGB")
+    return out.getvalue(), np.frombuffer(decoded, np.uint8).reshape(height, width, 3)
+
+
+def tight_encoder(image, filter_name="copy"):
+    """fill for flat tiles, the palette filter for up to 16 colors and otherwise the copy filter,
+       the gradient filter or JPEG as chosen by filter_name"""
+    height, width = image.shape[:2]
+    streams = [zlib.compressobj(6) for _ in range(4)]
+    parts = []
+    for x, y, w, h in tiles(width, height, 64):
+        tile = image[y:y + h, x:x + w]
+        found = palette_of(tile, 16)
+        if found is not None and len(found[0]) == 1:
+            parts.append((x, y, w, h, b"\x80" + tile[0, 0, :3].tobytes(), None, None))
+        elif found is not None:
+            colors, indices = found
+            data = pack_bits(indices, 1) if len(colors) == 2 else indices.tobytes()
+            palette = b"".join(color_bytes(color)[:3] for color in colors.tolist())
+            parts.append((x, y, w, h, b"\x50\x01" + bytes([len(colors) - 1]) + palette, 1, data))
+        elif filter_name == "gradient":
+            parts.append((x, y, w, h, b"\x60\x02", 2, gradient_encode(tile[..., :3]).tobytes()))
+        elif filter_name == "jpeg":
+            data, tile[..., :3] = jpeg(np.ascontiguousarray(tile[..., :3]))  # the screen becomes what JPEG decodes to
+            parts.append((x, y, w, h, b"\x90" + compact_length(len(data)) + data, None, None))
+        else:
+            parts.append((x, y, w, h, b"\x00", 0, tile[..., :3].tobytes()))
+
+    def encode():
+        rectangles = []
+        for x, y, w, h, control, stream, data in parts:
+            if data is not None and len(data) >= 12:
+                data = streams[stream].compress(data) + streams[stream].flush(zlib.Z_SYNC_FLUSH)
+                data = compact_length(len(data)) + data
+            rectangles.append(header(x, y, w, h, rfb.TIGHT_ENCODING) + control + (data or b""))
+        return rectangles
+    return encode
+
+
+def tight_gradient_encoder(image):
+    return tight_encoder(image, "gradient")
+
+
+def tight_jpeg_encoder(image):
+    return tight_encoder(image, "jpeg")
+
+
+ENCODERS = {
+    "raw": raw_encoder,
+    "copyrect": copyrect_encoder,
+    "rre": rre_encoder,
+    "corre": corre_encoder,
+    "hextile": hextile_encoder,
+    "zlibhex": zlibhex_encoder,
+    "zlib": zlib_encoder,
+    "zrle": zrle_encoder,
+    "tight": tight_encoder,
+    "tight-gradient": tight_gradient_encoder,
+    "tight-jpeg": tight_jpeg_encoder,
+}
+
+
+# --- measurement
+
+def measure(protocol, updates, chunk):
+    """feed the updates in chunk sized pieces, returns the rates"""
+    frames, rectangles = protocol.frames, protocol.rectangle_count
+    size = sum(len(data) for data in updates)
+    start = time.perf_counter()
+    for data in updates:
+        for pos in range(0, len(data), chunk):
+            protocol.dataReceived(data[pos:pos + chunk])
+    seconds = time.perf_counter() - start
+    frames, rectangles = protocol.frames - frames, protocol.rectangle_count - rectangles
+    return {
+        "bytes": size,
+        "frames": frames,
+        "rectangles": rectangles,
+        "seconds": seconds,
+        "mb_s": size / seconds / 1e6,
+        "rectangles_s": rectangles / seconds,
+        "frames_s": frames / seconds,
+    }
+
+
+def bench_encoding(name, width, height, repeat, chunk):
+    image = desktop(width, height)
+    encode = ENCODERS[name](image)
+    updates = [update(encode()) for _ in range(repeat + 1)]
+    protocol = connect(width=width, height=height)
+    measure(protocol, updates[:1], chunk)  # warm up
+    result = measure(protocol, updates[1:], chunk)
+    if not (protocol.framebuffer == image).all() and name != "copyrect":
+        raise AssertionError("%s decoded a different screen" % name)
+    return result
+
+
+def bench_capture(path, chunk):
+    chunks = [data for _, data in capture_chunks(path)]
+    data = b"".join(chunks)
+    _, _, _, namelength = struct.unpack("!HH16sI", data[:24])
+    # the ServerInit of a capture carries the pixel format of the captured session
+    protocol = connect(server_init=data[:24 + namelength], native_format=True)
+    return measure(protocol, [data[24 + namelength:]], chunk)
+
+
+def compare(results, previous):
+    """frames/s now versus the previous run, matched by name and screen size"""
+    before = {(r["name"], r["width"], r["height"]): r for r in previous["results"]}
+    print("\n%-20s %11s %12s %12s %8s" % ("", "size", "before fps", "now fps", "change"))
+    for r in results:
+        old = before.get((r["name"], r["width"], r["height"]))
+        if old is None:
+            continue
+        print("%-20s %5dx%-5d %12.1f %12.1f %+7.1f%%" % (r["name"], r["width"], r["height"], old["frames_s"],
+                                                         r["frames_s"], 100 * (r["frames_s"] / old["frames_s"] - 1)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="1024x768,1920x1080", help="comma separated WIDTHxHEIGHT")
+    parser.add_argument("--encodings", default=",".join(ENCODERS), help="comma separated, from " + ",".join(ENCODERS))
+    parser.add_argument("--capture", action="append", default=[], help="capture file to measure, may be repeated")
+    parser.add_argument("--chunk", default=65536, type=int, help="bytes per dataReceived call")
+    parser.add_argument("--repeat", default=5, type=int, help="updates per measurement")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON file of a previous run")
+    args = parser.parse_args()
+
+    results = []
+    print("%-20s %11s %12s %10s %12s %10s" % ("", "size", "bytes/frame", "MB/s", "rects/s", "frames/s"))
+    jobs = [(name, tuple(int(v) for v in size.split("x"))) for size in args.sizes.split(",")
+            for name in args.encodings.split(",")]
+    jobs += [(path, None) for path in args.capture]
+    for name, size in jobs:
+        if size is None:
+            result = bench_capture(name, args.chunk)
+            protocol_size = (0, 0)
+        else:
+            result = bench_encoding(name, size[0], size[1], args.repeat, args.chunk)
+            protocol_size = size
+        result.update(name=name, width=protocol_size[0], height=protocol_size[1])
+        results.append(result)
+        print("%-20s %5dx%-5d %12d %10.1f %12.0f %10.1f" % (
+            os.path.basename(name), protocol_size[0], protocol_size[1], result["bytes"] // max(result["frames"], 1),
+            result["mb_s"], result["rectangles_s"], result["frames_s"]))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"python": platform.python_version(), "numpy": np.__version__, "machine": platform.machine(),
+                       "chunk": args.chunk, "repeat": args.repeat, "results": results}, f, indent=1)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
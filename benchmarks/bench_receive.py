@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""
+Receive buffer microbenchmark.
+
+Feeds framebuffer updates through RFBClient.dataReceived in TCP sized chunks
+and reports how many bytes per second the protocol parses. The hextile case
+consists of thousands of tiny expect() calls, the raw case of one large block
+arriving in many chunks. The display callbacks are no-ops, so only the
+receive path is measured.
+
+usage: python benchmarks/bench_receive.py [--width 1920] [--height 1080] [--chunk 65536]
+"""
+import argparse
+import os
+import struct
+import sys
+import time
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from pyVNC import rfb
+
+
+class NullTransport:
+    def write(self, data):
+        pass
+
+    def loseConnection(self):
+        pass
+
+
+class NullClient(rfb.RFBClient):
+    def vnc_connection_made(self):
+        self.set_pixel_format()
+
+
+def connect(width, height):
+    factory = rfb.RFBFactory()
+    protocol = NullClient()
+    protocol.factory = factory
+    protocol.makeConnection(NullTransport())
+    pixformat = struct.pack("!BBBBHHHBBBxxx", 32, 24, 0, 1, 255, 255, 255, 0, 8, 16)
+    protocol.dataReceived(b"RFB 003.003\n")
+    protocol.dataReceived(struct.pack("!I", 1))
+    protocol.dataReceived(struct.pack("!HH16sI", width, height, pixformat, 5) + b"bench")
+    return protocol
+
+
+def raw_update(width, height):
+    header = struct.pack("!BxHHHHHI", 0, 1, 0, 0, width, height, rfb.RAW_ENCODING)
+    return header + bytes(range(256)) * (width * height * 4 // 256)
+
+
+def hextile_update(width, height):
+    """every tile only specifies a background color"""
+    header = struct.pack("!BxHHHHHI", 0, 1, 0, 0, width, height, rfb.HEXTILE_ENCODING)
+    tiles = ((width + 15) // 16) * ((height + 15) // 16)
+    return header + b"\x02\x10\x20\x30\x00" * tiles
+
+
+def hextile_raw_update(width, height):
+    """every tile is sent raw"""
+    header = struct.pack("!BxHHHHHI", 0, 1, 0, 0, width, height, rfb.HEXTILE_ENCODING)
+    tiles = b""
+    for ty in range(0, height, 16):
+        for tx in range(0, width, 16):
+            tiles += b"\x01" + b"\x80" * (min(16, width - tx) * min(16, height - ty) * 4)
+    return header + tiles
+
+
+def run(protocol, update, chunk, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for pos in range(0, len(update), chunk):
+            protocol.dataReceived(update[pos:pos + chunk])
+    elapsed = time.perf_counter() - start
+    return len(update) * repeat / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--width", default=1920, type=int)
+    parser.add_argument("--height", default=1080, type=int)
+    parser.add_argument("--chunk", default=65536, type=int, help="bytes per dataReceived call")
+    parser.add_argument("--repeat", default=5, type=int)
+    args = parser.parse_args()
+
+    protocol = connect(args.width, args.height)
+    for name, update in (("raw", raw_update(args.width, args.height)),
+                         ("hextile", hextile_update(args.width, args.height)),
+                         ("hextile-raw", hextile_raw_update(args.width, args.height))):
+        rate = run(protocol, update, args.chunk, args.repeat)
+        print("%-12s %8d bytes/update %10.1f MB/s" % (name, len(update), rate / 1e6))
+
+
+if __name__ == '__main__':
+    main()
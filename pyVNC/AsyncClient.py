@@ -0,0 +1,155 @@
+import asyncio
+from pyVNC.Buffer import ArrayBuffer
+from pyVNC.VNCFactory import VNCFactory
+import logging
+logger = logging.getLogger("pyVNC")
+
+# bytes the event loop may read into the receive buffer at once
+READ_SIZE = 1 << 16
+
+
+class AsyncTransport:
+    """The twisted transport methods RFBClient uses, on top of an asyncio transport"""
+
+    def __init__(self, transport):
+        self.transport = transport
+
+    def write(self, data):
+        self.transport.write(data)
+
+    def writeSequence(self, data):
+        self.transport.writelines(data)
+
+    def loseConnection(self):
+        self.transport.close()
+
+    def abortConnection(self):
+        self.transport.abort()
+
+    def getPeer(self):
+        return self.transport.get_extra_info("peername")
+
+
+class AsyncRFBProtocol(asyncio.BufferedProtocol):
+    """Drives the RFBClient state machine from an asyncio event loop.
+       The kernel reads straight into the receive buffer of the RFBClient."""
+
+    def __init__(self, client, rfb):
+        self.client = client
+        self.rfb = rfb
+        self._can_write = asyncio.Event()
+        self._can_write.set()
+
+    def connection_made(self, transport):
+        self.rfb.makeConnection(AsyncTransport(transport))
+
+    def get_buffer(self, sizehint):
+        return self.rfb.get_receive_buffer(max(sizehint, READ_SIZE))
+
+    def buffer_updated(self, nbytes):
+        self.rfb.receive_buffer_updated(nbytes)
+
+    def pause_writing(self):
+        self._can_write.clear()
+
+    def resume_writing(self):
+        self._can_write.set()
+
+    async def drain(self):
+        await self._can_write.wait()
+
+    def connection_lost(self, exc):
+        self._can_write.set()
+        self.rfb.connectionLost(exc)
+        self.client.connection_lost(exc)
+
+
+class AsyncArrayBuffer(ArrayBuffer):
+    """ArrayBuffer that reports the connection setup and completed updates to an AsyncClient"""
+
+    def __init__(self, client):
+        super().__init__()
+        self.client = client
+
+    def set_rfb_size(self, width, height, depth=32):
+        super().set_rfb_size(width, height, depth)
+        # the protocol still sends its encodings and first request after this
+        asyncio.get_running_loop().call_soon(self.client.connection_made)
+
+    def update_complete(self, rectangles=None):
+        super().update_complete(rectangles)
+        self.client.frame_complete()
+
+
+class AsyncClient:
+    """VNC client for asyncio applications. Many clients can share one event loop.
+
+        vnc = await AsyncClient(host="127.0.0.1", port=5902).connect()
+        array = await vnc.next_frame()
+        await vnc.key_event(ord("a"), down=1)
+    """
+
+    def __init__(self, host="127.0.0.1", password=None, port=5902, **options):
+        """the options (depth, fast, shared, jpeg_quality, ...) are those of VNCFactory"""
+        self.host = host
+        self.port = port
+        self.screen = AsyncArrayBuffer(self)
+        self.factory = VNCFactory(self.screen, password=password, **options)
+        self.protocol = None
+        self._closing = False
+        self._connected = None
+        self._frame_waiters = []
+
+    async def connect(self):
+        """open the connection and wait until the session is initialized"""
+        loop = asyncio.get_running_loop()
+        self._connected = loop.create_future()
+        rfb = self.factory.protocol()
+        rfb.factory = self.factory
+        rfb.schedule_flush = loop.call_soon_threadsafe  # queued messages are written by the event loop
+        rfb.call_later = loop.call_later  # paced update requests
+        _, self.protocol = await loop.create_connection(lambda: AsyncRFBProtocol(self, rfb), self.host, self.port)
+        await self._connected
+        return self
+
+    async def next_frame(self):
+        """wait for the next completed framebuffer update and return the screen array"""
+        waiter = asyncio.get_running_loop().create_future()
+        self._frame_waiters.append(waiter)
+        return await waiter
+
+    async def key_event(self, key, down=1):
+        self.screen.protocol.key_event(key, down)
+        await self.protocol.drain()
+
+    async def pointer_event(self, x, y, buttonmask=0):
+        self.screen.protocol.pointer_event(x, y, buttonmask)
+        await self.protocol.drain()
+
+    def close(self):
+        self._closing = True
+        if self.protocol is not None:
+            self.protocol.rfb.transport.loseConnection()
+
+    def connection_made(self):
+        if not self._connected.done():
+            self._connected.set_result(None)
+
+    def frame_complete(self):
+        waiters, self._frame_waiters = self._frame_waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(self.screen.get_array())
+
+    def connection_lost(self, exc):
+        error = ConnectionError("VNC connection to %s:%s lost" % (self.host, self.port))
+        if exc is not None:
+            error.__cause__ = exc
+        if not self._closing:
+            logger.error(str(error))
+        waiters, self._frame_waiters = self._frame_waiters, []
+        if self._connected is not None and not self._connected.done():
+            waiters.append(self._connected)
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_exception(error)
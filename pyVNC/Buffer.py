@@ -1,30 +1,259 @@
 import pygame
 import numpy as np
+import threading
+import time
+from collections import namedtuple, deque
 from pyVNC.constants import *
+from pyVNC.PixelFormat import PixelConverter, NativePixels
 from twisted.internet import reactor
+from twisted.python import threadable
+
+# a completed framebuffer update, seq counts the updates and timestamp is the time.time() of the commit
+Frame = namedtuple("Frame", ["seq", "timestamp", "array", "rectangles"])
+
+# number of RGB arrays the updates rotate through, a published array is not written
+# again until FRONT_BUFFERS - 1 more updates have completed
+FRONT_BUFFERS = 3
+
+# seconds of completed updates the measured frame rate is averaged over
+FPS_WINDOW = 2.0
+
+# seconds a CompactBuffer read waits for the update that is being decoded, and the number of
+# reads before it gives up on an unchanged framebuffer and returns what it has
+READ_TIMEOUT = 1.0
+READ_ATTEMPTS = 3
+
+
+def clip_region(region, size):
+    """region (x, y, width, height) clipped to a screen of size (width, height), it may become empty"""
+    x, y, width, height = region
+    left, top = max(x, 0), max(y, 0)
+    right, bottom = min(x + width, size[0]), min(y + height, size[1])
+    return left, top, max(right - left, 0), max(bottom - top, 0)
+
+
+def _resolve(future, frame):
+    if not future.done():
+        future.set_result(frame)
 
 
 class Buffer:
 
     def __init__(self):
+        self.framebuffer = None
         self.canvas = None
         self._canvas = None
         self.protocol = None
         self.size = (None, None)
         self.area = (None, None, None, None)
+        self.rectangles = []  # (x, y, width, height) changed by the last update
+        self.seq = 0  # number of completed updates
+        self.timestamp = None  # time of the last completed update
+        self.frame_condition = threading.Condition()
+        self._frame_waiters = []  # (loop, future) of coroutines waiting for the next update
+        self.fronts = []  # RGB arrays the published frames point to
+        self.front_seqs = []  # seq of the update each front holds, -1 while it is written
+        self._front = 0  # index of the published front
+        self._history = deque(maxlen=FRONT_BUFFERS)  # rectangles of the last updates
+        self.frame = Frame(0, None, None, [])  # the published frame, replaced as a whole
+        self._frame_times = deque()  # time.time() of the updates of the last FPS_WINDOW seconds
+        self._first_frame_time = None
+        self.writing = False  # an update is being decoded into the framebuffer
 
     def set_protocol(self, protocol):
         self.protocol = protocol
 
+    def set_pixel_converter(self, converter):
+        """the PixelConverter of the connection, returns the one that writes the framebuffer"""
+        return converter
+
     def set_rfb_size(self, width, height, depth=32):
         self.size = (width, height)
         self.area = (0, 0, width, height)
 
-        self.canvas = pygame.Surface(self.size, 0, 32)
-
-    def update_complete(self):
+        # RGBX framebuffer that the protocol decodes into, the canvas surface shares its memory
+        self.framebuffer = np.zeros(shape=(height, width, 4), dtype=np.uint8)
+        self.canvas = pygame.image.frombuffer(self.framebuffer, self.size, 'RGBX')
+
+    def begin_update(self):
+        self.writing = True
+
+    def update_aborted(self):
+        """the connection was lost during an update, its partly written framebuffer is not published"""
+        with self.frame_condition:
+            self.writing = False
+            self.frame_condition.notify_all()
+
+    def rgb(self, pixels):
+        """pixels in the layout of the framebuffer as an array whose [..., :3] is red, green, blue"""
+        return pixels
+
+    def memory(self):
+        """bytes of the framebuffer, the exported arrays, and of the connection: its receive
+           buffer and the colour tables only it uses"""
+        usage = {"framebuffer": self.framebuffer.nbytes if self.framebuffer is not None else 0,
+                 "arrays": sum(front.nbytes for front in self.fronts)}
+        if self.protocol is not None:
+            usage.update(self.protocol.memory())
+        usage["total"] = sum(usage.values())
+        return usage
+
+    def update_complete(self, rectangles=None):
+        self.rectangles = [self.area] if rectangles is None else rectangles
+        self.draw(self.rectangles)
+        self.publish()
+
+    def draw(self, rectangles):
+        """show the changed regions of the framebuffer"""
         pass
 
+    def publish(self):
+        """number the completed update, swap in its frame and wake the threads and coroutines waiting for it"""
+        with self.frame_condition:
+            self.seq += 1
+            self.timestamp = time.time()
+            self.frame = Frame(self.seq, self.timestamp, self._canvas, self.rectangles)
+            self.writing = False
+            if self._first_frame_time is None:
+                self._first_frame_time = self.timestamp
+            self._frame_times.append(self.timestamp)
+            while self._frame_times[0] < self.timestamp - FPS_WINDOW:
+                self._frame_times.popleft()
+            self.frame_condition.notify_all()
+            waiters, self._frame_waiters = self._frame_waiters, []
+
+        frame = self.get_frame() if waiters else None
+        for loop, future in waiters:
+            # a consumer that gave up or whose loop is gone must not break the protocol
+            if future.done() or loop.is_closed():
+                continue
+            try:
+                loop.call_soon_threadsafe(_resolve, future, frame)
+            except RuntimeError:  # the loop was closed meanwhile
+                pass
+
+    def get_array(self):
+        return self.frame.array
+
+    def fps(self):
+        """completed updates per second over the last FPS_WINDOW seconds"""
+        with self.frame_condition:
+            if self._first_frame_time is None:
+                return 0.0
+            now = time.time()
+            recent = sum(1 for timestamp in self._frame_times if timestamp >= now - FPS_WINDOW)
+            elapsed = min(FPS_WINDOW, now - self._first_frame_time)
+        return recent / elapsed if elapsed > 0 else 0.0
+
+    def get_frame(self):
+        """the last published frame. its array is not written before FRONT_BUFFERS - 1 more
+           updates completed, use frame_intact to check or copy the array to keep it longer"""
+        return self.frame
+
+    def frame_intact(self, frame):
+        """True while the array of the frame still holds the pixels of that update"""
+        for front, seq in zip(self.fronts, self.front_seqs):
+            if front is frame.array:
+                return seq == frame.seq
+        return False
+
+    def wait_for_frame(self, after_seq=None, timeout=None):
+        """block until an update newer than after_seq (default: the current one) completed.
+           returns the Frame or None on timeout"""
+        with self.frame_condition:
+            if after_seq is None:
+                after_seq = self.seq
+            if not self.frame_condition.wait_for(lambda: self.seq > after_seq, timeout):
+                return None
+        return self.get_frame()
+
+    def add_frame_waiter(self, loop, future, after_seq=None):
+        """resolve the asyncio future with the first Frame newer than after_seq"""
+        with self.frame_condition:
+            if after_seq is None or self.seq <= after_seq:
+                waiter = (loop, future)
+                self._frame_waiters.append(waiter)
+                future.add_done_callback(lambda _: self._remove_frame_waiter(waiter))
+                return
+        _resolve(future, self.get_frame())
+
+    def _remove_frame_waiter(self, waiter):
+        """drop the waiter of a cancelled or timed out future, resolved ones are already gone"""
+        with self.frame_condition:
+            if waiter in self._frame_waiters:
+                self._frame_waiters.remove(waiter)
+
+    def get_region(self, region):
+        """the region (x, y, width, height) of the screen array, a view without copy"""
+        x, y, width, height = clip_region(region, self.size)
+        return self.get_array()[y:y + height, x:x + width]
+
+    def get_rectangles(self):
+        """regions (x, y, width, height) that changed with the last update"""
+        return self.frame.rectangles
+
+    def region_frame(self, frame, region):
+        """the frame restricted to region (x, y, width, height): the array is a view of the frame's
+           array and the rectangles are the changed parts of the region, relative to it.
+           the region is clipped to the screen first"""
+        x, y, width, height = clip_region(region, frame.array.shape[1::-1])
+        rectangles = []
+        for rx, ry, rwidth, rheight in frame.rectangles:
+            left, top = max(rx, x), max(ry, y)
+            right, bottom = min(rx + rwidth, x + width), min(ry + rheight, y + height)
+            if left < right and top < bottom:
+                rectangles.append((left - x, top - y, right - left, bottom - top))
+        return frame._replace(array=frame.array[y:y + height, x:x + width], rectangles=rectangles)
+
+    def wait_for_region(self, region, after_seq=None, timeout=None):
+        """block until an update newer than after_seq changed the region, returns its region_frame
+           or None on timeout. when updates were skipped while the caller was busy the region may
+           not have changed, the frame is returned anyway"""
+        deadline = None if timeout is None else time.time() + timeout
+        seq = self.seq if after_seq is None else after_seq
+        while True:
+            remaining = None if deadline is None else max(deadline - time.time(), 0)
+            frame = self.wait_for_frame(seq, remaining)
+            if frame is None:
+                return None
+            clipped = self.region_frame(frame, region)
+            if clipped.rectangles or frame.seq > seq + 1:
+                return clipped
+            seq = frame.seq
+
+    def set_fronts(self, fronts):
+        """use the given RGB arrays, which must match the framebuffer, as the exported arrays"""
+        self.fronts = fronts
+        self.front_seqs = [self.seq] * len(fronts)
+        self._front = 0
+        self._history.clear()
+        self._canvas = fronts[0]
+        self.frame = Frame(self.seq, self.timestamp, self._canvas, [])
+
+    def refresh_array(self, rectangles):
+        """bring the next front up to date with the framebuffer, it becomes _canvas.
+           Readers of the published front are not disturbed."""
+        index = (self._front + 1) % len(self.fronts)
+        front = self.fronts[index]
+        missed = self.seq - self.front_seqs[index]  # earlier updates the front does not have
+        self.front_seqs[index] = -1
+
+        if missed > len(self._history):
+            regions = [self.area]
+        else:
+            regions = [r for update in list(self._history)[len(self._history) - missed:] for r in update]
+            regions.extend(rectangles)
+            if sum(width * height for _, _, width, height in regions) >= self.size[0] * self.size[1]:
+                regions = [self.area]
+
+        for x, y, width, height in regions:
+            front[y:y + height, x:x + width] = self.rgb(self.framebuffer[y:y + height, x:x + width])[..., :3]
+
+        self._history.append(rectangles)
+        self.front_seqs[index] = self.seq + 1  # publish() numbers this update
+        self._front = index
+        self._canvas = front
+
     def loop(self):
         pass
 
@@ -33,13 +262,87 @@ class ArrayBuffer(Buffer):
 
     def __init__(self):
         super().__init__()
-        self._canvas = np.ndarray(shape=(10, 10, 3), dtype=np.uint8)
+        self.set_fronts([np.ndarray(shape=(10, 10, 3), dtype=np.uint8)])
+
+    def set_rfb_size(self, width, height, depth=32):
+        super().set_rfb_size(width, height, depth)
+        self.set_fronts([np.zeros(shape=(height, width, 3), dtype=np.uint8) for _ in range(FRONT_BUFFERS)])
 
-    def update_complete(self):
-        self._canvas = pygame.surfarray.array3d(self.canvas).swapaxes(0, 1)
+    def draw(self, rectangles):
+        self.refresh_array(rectangles)
+
+
+class CompactBuffer(Buffer):
+    """Keeps one framebuffer per session in a compact layout and materializes RGB arrays on read.
+
+    The framebuffer holds packed RGB, or the pixels of the connection when they are smaller
+    (RGB565, BGR233 or a colour map). get_array and get_frame return new arrays the caller owns.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.reader = None  # PixelConverter of the pixels the framebuffer keeps, None for RGB
+
+    def set_pixel_converter(self, converter):
+        if converter.bypp < 3:
+            self.reader = converter
+            return NativePixels(converter.bypp)
+        self.reader = None
+        return PixelConverter(*converter.format, channels=3)
+
+    def set_rfb_size(self, width, height, depth=32):
+        self.size = (width, height)
+        self.area = (0, 0, width, height)
+        channels = 3 if self.reader is None else self.reader.bypp
+        self.framebuffer = np.zeros(shape=(height, width, channels), dtype=np.uint8)
+
+    def rgb(self, pixels):
+        if self.reader is None:
+            return pixels
+        return self.reader.rgbx(pixels).reshape(pixels.shape[:-1] + (4,))
+
+    def materialize(self, region=None):
+        """the framebuffer, or its region (x, y, width, height), as a new (height, width, 3) RGB array"""
+        if self.framebuffer is None:
+            return None
+        pixels = self.framebuffer
+        if region is not None:
+            x, y, width, height = region
+            pixels = pixels[y:y + height, x:x + width]
+        if self.reader is None:
+            return pixels.copy()
+        return np.ascontiguousarray(self.rgb(pixels)[..., :3])
+
+    def _read(self, region=None):
+        """(frame, materialized array) of the last published update. a read that overlaps an update
+           is repeated, after READ_ATTEMPTS or a timed out wait it may mix pixels of consecutive updates"""
+        wait = not threadable.isInIOThread()
+        for _ in range(READ_ATTEMPTS):
+            with self.frame_condition:
+                if wait:
+                    wait = self.frame_condition.wait_for(lambda: not self.writing, READ_TIMEOUT)
+                frame = self.frame
+            array = self.materialize(region)
+            with self.frame_condition:
+                if self.frame is frame and not self.writing:
+                    break
+        return frame, array
+
+    def get_frame(self):
+        """the last published frame with a materialized array"""
+        frame, array = self._read()
+        return frame._replace(array=array)
 
     def get_array(self):
-        return self._canvas
+        return self._read()[1]
+
+    def get_region(self, region):
+        """the region (x, y, width, height) of the screen, only the region is materialized"""
+        return self._read(clip_region(region, self.size))[1]
+
+    def frame_intact(self, frame):
+        """materialized arrays are not written again"""
+        return True
 
 
 class DisplayBuffer(Buffer):
@@ -63,15 +366,16 @@ class DisplayBuffer(Buffer):
         self.background = pygame.Surface(self.size, depth)
         self.background.fill(0)  # black
 
-    def update_complete(self):
         if self.include_array:
-            self._canvas = pygame.surfarray.array3d(self.canvas).swapaxes(0, 1)
+            self.set_fronts([np.zeros(shape=(height, width, 3), dtype=np.uint8) for _ in range(FRONT_BUFFERS)])
 
-        self.window.blit(self.canvas, (0, 0))
-        pygame.display.update()
+    def draw(self, rectangles):
+        if self.include_array:
+            self.refresh_array(rectangles)
 
-    def get_array(self):
-        return self._canvas
+        for area in rectangles:
+            self.window.blit(self.canvas, area[:2], area)
+        pygame.display.update(rectangles)
 
     def loop(self, dum=None):
         no_work = self.check_events()
@@ -0,0 +1,131 @@
+import time
+from bisect import bisect_left
+
+# upper bounds of the histogram buckets, values above the last bound go to an extra bucket
+LATENCY_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0)  # seconds
+RECTANGLE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096)
+
+
+class Histogram:
+    """Counts values in fixed buckets"""
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def quantile(self, q):
+        """upper bound of the bucket that holds the q quantile, None above the last bound"""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+    def snapshot(self):
+        return {
+            "bounds": list(self.bounds),
+            "counts": list(self.counts),
+            "count": self.count,
+            "sum": self.total,
+            "mean": self.total / self.count if self.count else None,
+            "p50": self.quantile(0.5) if self.count else None,
+            "p90": self.quantile(0.9) if self.count else None,
+            "p99": self.quantile(0.99) if self.count else None,
+        }
+
+
+class Metrics:
+    """Counters and histograms of one RFB connection, updated by RFBClient from the reactor thread.
+
+    Decode time is charged to the encoding of the rectangle that is being received, time spent
+    on message headers and other messages to None. Only time spent handling received data counts.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.bytes_received = 0
+        self.updates = 0
+        self.rectangles = 0
+        self.encoding_rectangles = {}  # encoding -> rectangles received
+        self.encoding_seconds = {}  # encoding or None -> seconds spent decoding
+        self.request_time = None  # perf_counter of the oldest update request that was not answered yet
+        self.latency = Histogram(LATENCY_BUCKETS)  # update request to completed update
+        self.update_time = Histogram(LATENCY_BUCKETS)  # first to last byte of an update
+        self.rectangles_per_update = Histogram(RECTANGLE_BUCKETS)
+        self._account = None  # encoding the running time is charged to
+        self._since = None  # perf_counter when the account was last charged, None while idle
+        self._update_started = None
+
+    def resume(self):
+        """received data is being handled"""
+        self._since = time.perf_counter()
+
+    def pause(self):
+        """all received data was handled"""
+        self._charge(time.perf_counter())
+        self._since = None
+
+    def _charge(self, now):
+        if self._since is not None:
+            self.encoding_seconds[self._account] = self.encoding_seconds.get(self._account, 0.0) + now - self._since
+
+    def switch(self, account):
+        now = time.perf_counter()
+        self._charge(now)
+        self._account = account
+        self._since = now
+
+    def rectangle(self, encoding):
+        self.rectangles += 1
+        self.encoding_rectangles[encoding] = self.encoding_rectangles.get(encoding, 0) + 1
+        self.switch(encoding)
+
+    def request_sent(self):
+        if self.request_time is None:
+            self.request_time = time.perf_counter()
+
+    def update_started(self):
+        self._update_started = time.perf_counter()
+
+    def update_complete(self, rectangles):
+        now = time.perf_counter()
+        self.updates += 1
+        self.rectangles_per_update.observe(rectangles)
+        if self._update_started is not None:
+            self.update_time.observe(now - self._update_started)
+        # one update answers all outstanding requests, its latency counts from the oldest
+        if self.request_time is not None:
+            self.latency.observe(now - self.request_time)
+            self.request_time = None
+
+    def snapshot(self, names=None):
+        """the metrics as a dict of plain values, names maps encoding numbers to names"""
+        names = names or {}
+        elapsed = time.time() - self.started
+        encodings = {}
+        for encoding, seconds in list(self.encoding_seconds.items()):
+            if encoding is not None:
+                encodings[names.get(encoding, encoding)] = {"rectangles": self.encoding_rectangles.get(encoding, 0),
+                                                            "seconds": seconds}
+        return {
+            "elapsed": elapsed,
+            "bytes_received": self.bytes_received,
+            "bytes_per_second": self.bytes_received / elapsed if elapsed else 0.0,
+            "updates": self.updates,
+            "updates_per_second": self.updates / elapsed if elapsed else 0.0,
+            "rectangles": self.rectangles,
+            "encodings": encodings,
+            "other_seconds": self.encoding_seconds.get(None, 0.0),
+            "latency": self.latency.snapshot(),
+            "update_time": self.update_time.snapshot(),
+            "rectangles_per_update": self.rectangles_per_update.snapshot(),
+        }
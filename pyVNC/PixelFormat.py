@@ -0,0 +1,145 @@
+from functools import lru_cache
+import numpy as np
+
+# entries of a colour map, the first-colour and number-of-colours fields are 16 bits
+COLOUR_MAP_SIZE = 1 << 16
+
+# SetPixelFormat arguments of the depths a client can ask for: RGBX, RGB565 and BGR233
+PIXEL_FORMATS = {
+    32: dict(bpp=32, depth=24, bigendian=0, truecolor=1, redmax=255, greenmax=255, bluemax=255,
+             redshift=0, greenshift=8, blueshift=16),
+    16: dict(bpp=16, depth=16, bigendian=0, truecolor=1, redmax=31, greenmax=63, bluemax=31,
+             redshift=11, greenshift=5, blueshift=0),
+    8: dict(bpp=8, depth=8, bigendian=0, truecolor=1, redmax=7, greenmax=7, bluemax=3,
+            redshift=0, greenshift=3, blueshift=6),
+}
+
+
+def _pixel_bytes(data):
+    """pixel data (bytes, memoryview or array) as a flat uint8 array, without copy where possible"""
+    if isinstance(data, np.ndarray):
+        return np.ascontiguousarray(data, dtype=np.uint8).reshape(-1)
+    return np.frombuffer(data, np.uint8)
+
+
+def _scale(values, maximum):
+    """channel values of 0 to maximum as 0 to 255"""
+    if maximum == 255:
+        return values.astype(np.uint8)
+    return ((values.astype(np.uint32) * 255 + maximum // 2) // max(maximum, 1)).astype(np.uint8)
+
+
+def _rgbx_values(values, maxes, shifts):
+    """true colour pixel values (uint32) as RGBX, little endian uint32"""
+    rgbx = np.zeros(values.shape + (4,), dtype=np.uint8)
+    for channel, (maximum, shift) in enumerate(zip(maxes, shifts)):
+        rgbx[..., channel] = _scale(values >> shift & maximum, maximum)
+    return rgbx.view('<u4').reshape(values.shape)
+
+
+@lru_cache(maxsize=None)
+def _truecolor_lut(bpp, maxes, shifts):
+    """read only RGBX table of every 8 or 16 bit true colour pixel value, shared by the sessions of a format"""
+    lut = _rgbx_values(np.arange(1 << bpp, dtype=np.uint32), maxes, shifts)
+    lut.setflags(write=False)
+    return lut
+
+
+class PixelConverter:
+    """Converts pixel data of an RFB pixel format to RGBX rows, the layout of the framebuffer,
+    or to RGB rows when channels is 3.
+
+    32 bit formats with byte aligned 8 bit channels are reordered bytes (no copy for RGBX itself),
+    8 and 16 bit formats go through a lookup table of all pixel values and other 32 bit formats
+    are shifted and masked. Colour map formats use a table that the server fills, the true colour
+    tables are shared.
+    """
+
+    def __init__(self, bpp=32, depth=24, bigendian=0, truecolor=1, redmax=255, greenmax=255, bluemax=255,
+                 redshift=0, greenshift=8, blueshift=16, channels=4):
+        if bpp not in (8, 16, 32):
+            raise ValueError("%d bits per pixel are not supported" % bpp)
+        self.format = (bpp, depth, bigendian, truecolor, redmax, greenmax, bluemax, redshift, greenshift, blueshift)
+        self.channels = channels  # bytes per converted pixel
+        self.bpp = bpp
+        self.depth = depth
+        self.bypp = bpp // 8
+        self.truecolor = truecolor
+        self.maxes = (redmax, greenmax, bluemax)
+        self.shifts = (redshift, greenshift, blueshift)
+        self.dtype = np.dtype(('>u%d' if bigendian else '<u%d') % self.bypp)
+        self.order = None  # byte of red, green, blue and the padding in a 32 bit pixel
+        self.lut = None  # RGBX of every pixel value, as little endian uint32
+
+        if not truecolor:
+            self.lut = np.zeros(COLOUR_MAP_SIZE if bpp > 8 else 256, dtype='<u4')
+        elif bpp < 32:
+            self.lut = _truecolor_lut(bpp, self.maxes, self.shifts)
+        elif self.maxes == (255, 255, 255) and all(shift % 8 == 0 for shift in self.shifts):
+            channels = [3 - shift // 8 if bigendian else shift // 8 for shift in self.shifts]
+            self.order = channels + [({0, 1, 2, 3} - set(channels)).pop()]
+        self.identity = self.order == [0, 1, 2, 3]  # the pixel data already is RGBX
+
+    @classmethod
+    def from_client(cls, client):
+        """converter for the pixel format an RFBClient currently uses"""
+        return cls(client.bpp, client.depth, client.bigendian, client.truecolor, client.redmax, client.greenmax,
+                   client.bluemax, client.redshift, client.greenshift, client.blueshift)
+
+    def table_bytes(self):
+        """bytes of the lookup table only this converter uses, the colour map"""
+        return self.lut.nbytes if self.lut is not None and not self.truecolor else 0
+
+    def set_colour_map(self, first, colours):
+        """colours is a (n, 3) array of 16 bit red, green, blue for the entries from first on"""
+        if self.lut is None or self.truecolor:
+            return
+        colours = (np.asarray(colours, dtype=np.uint32) >> 8).astype(np.uint8)[:len(self.lut) - first]
+        rgbx = np.zeros((len(colours), 4), dtype=np.uint8)
+        rgbx[:, :3] = colours
+        self.lut[first:first + len(colours)] = rgbx.view('<u4').reshape(-1)
+
+    def rgbx(self, data):
+        """(n, 4) uint8 array of the red, green, blue and padding bytes of the n pixels in data"""
+        raw = _pixel_bytes(data)
+        if self.order is not None:
+            pixels = raw.reshape(-1, 4)
+            return pixels if self.identity else pixels[:, self.order]
+        values = raw.view(self.dtype)
+        if self.lut is not None:
+            return np.take(self.lut, values, mode="clip").view(np.uint8).reshape(-1, 4)
+        return _rgbx_values(values.astype(np.uint32), self.maxes, self.shifts).view(np.uint8).reshape(-1, 4)
+
+    def pixels(self, data):
+        """(n, channels) uint8 array of the n pixels in data"""
+        rgbx = self.rgbx(data)
+        return rgbx if self.channels == 4 else rgbx[:, :self.channels]
+
+    def convert_into(self, data, out):
+        """write the pixels in data to out, a (height, width, channels) region of the framebuffer.
+           lookup tables are expanded directly into RGBX regions"""
+        if self.lut is not None and self.channels == 4:
+            values = _pixel_bytes(data).view(self.dtype).reshape(out.shape[:2])
+            np.take(self.lut, values, out=out.view('<u4')[..., 0], mode="clip")
+        else:
+            out[...] = self.pixels(data).reshape(out.shape)
+
+
+class NativePixels:
+    """Keeps pixel data as it is, for framebuffers in the pixel format of the connection"""
+
+    def __init__(self, bypp):
+        self.bypp = bypp
+        self.channels = bypp
+
+    def pixels(self, data):
+        return _pixel_bytes(data).reshape(-1, self.bypp)
+
+    def convert_into(self, data, out):
+        out[...] = self.pixels(data).reshape(out.shape)
+
+    def table_bytes(self):
+        return 0
+
+    def set_colour_map(self, first, colours):
+        pass
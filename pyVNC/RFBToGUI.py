@@ -1,6 +1,14 @@
-import pygame
-import struct
+import time
+import numpy as np
 import pyVNC.rfb
+from pyVNC.PixelFormat import PixelConverter, PIXEL_FORMATS
+from pyVNC.Buffer import clip_region
+
+# fill_rectangles paints few or large (average area in pixels) rectangles
+# one by one and scatters at most FILL_BATCH_PIXELS pixels per batch
+FILL_BATCH_MIN = 16
+FILL_BATCH_AREA = 64
+FILL_BATCH_PIXELS = 1 << 18
 
 
 class RFBToGUI(pyVNC.rfb.RFBClient):
@@ -9,8 +17,17 @@ class RFBToGUI(pyVNC.rfb.RFBClient):
     def __init__(self):
         super().__init__()
         self.buffer = None  # Buffer
+        self.framebuffer = None  # Buffer's framebuffer (height x width x RGBX, or the compact layout of the buffer)
         self.canvas = None  # Buffers Canvas
         self._canvas = None  # Buffer's _canvas
+        self.recorder = None  # Recorder that logs the rectangle operations
+        self._continuous_updates_offered = False  # the server acknowledged the ContinuousUpdates encoding
+        self._last_request = None  # perf_counter of the last incremental update request
+        self._request_call = None  # handle of the scheduled update request
+        self._last_update = None  # perf_counter of the last committed update
+        self._last_full_request = None  # perf_counter of the last request of the whole screen
+        self.pixel_format = None  # PixelConverter from the pixel format of the connection to RGBX
+        self.converter = None  # writes pixels of the connection in the layout of the framebuffer
 
     def vnc_connection_made(self):
         """choose appropriate color depth, resize screen"""
@@ -23,22 +40,35 @@ class RFBToGUI(pyVNC.rfb.RFBClient):
         # Define
         self.buffer = self.factory.buffer
 
-        # Set protocol and rfb (canvas size)
+        # Set encoding
+        self.set_encodings(self.factory.encodings)
+
+        # Set up the pixel format of the depth, or keep the one of the server, and convert on this side
+        if not self.factory.native_format:
+            self.set_pixel_format(**PIXEL_FORMATS[self.factory.depth])
+        self.pixel_format = PixelConverter.from_client(self)
+
+        # Set protocol and rfb (canvas size), the buffer chooses the layout of its framebuffer
         self.buffer.set_protocol(self)
+        self.converter = self.buffer.set_pixel_converter(self.pixel_format)
         self.buffer.set_rfb_size(self.width, self.height, 32)
 
         # Get canvas
+        self.framebuffer = self.buffer.framebuffer
         self.canvas = self.buffer.canvas
         self._canvas = self.buffer._canvas
 
-        # Set encoding
-        self.set_encodings(self.factory.encodings)
-
-        # Set up pixel format to 32 bits
-        self.set_pixel_format()
+        self.recorder = self.factory.recorder
+        if self.recorder is not None:
+            self.recorder.start(self.width, self.height)
 
-        # Request initial screen update
+        # Request initial screen update, further incremental requests fill the pipeline
+        # so the server has a request while the previous update is on its way
         self.framebuffer_update_request()
+        self._last_request = self._last_full_request = time.perf_counter()
+        if not self.factory.on_demand:
+            for _ in range(self.factory.pipeline - 1):
+                self.request_update()
 
     def vnc_request_password(self):
         if self.factory.password is not None:
@@ -47,54 +77,180 @@ class RFBToGUI(pyVNC.rfb.RFBClient):
     def begin_update(self):
         """begin series of display updates"""
         # ~ log.msg("screen lock")
+        self.buffer.begin_update()
 
     def commit_update(self, rectangles=None):
         """finish series of display updates"""
         # ~ log.msg("screen unlock")
-        self.buffer.update_complete()
-        self.framebuffer_update_request(incremental=1)
+        self.buffer.update_complete(rectangles)
+        if self.recorder is not None:
+            # the screen is only converted for the recorder when it writes a keyframe
+            timestamp = self.buffer.timestamp
+            screen = self.buffer.rgb(self.framebuffer) if self.recorder.keyframe_due(timestamp) else None
+            self.recorder.commit_update(screen, timestamp)
+        self._last_update = time.perf_counter()
+        self.schedule_update_request()
+
+    def schedule_update_request(self):
+        """request the next incremental update, no sooner than 1 / max_fps after the previous request.
+           nothing is requested in on demand mode or while the server pushes continuous updates"""
+        if self.continuous_updates or self.factory.on_demand or self._request_call is not None:
+            return
+        delay = 0.0
+        if self.factory.max_fps:
+            delay = self._last_request + 1.0 / self.factory.max_fps - time.perf_counter()
+        if delay > 0:
+            self._request_call = self.call_later(delay, self._scheduled_update_request)
+        else:
+            self.request_update()
+
+    def _scheduled_update_request(self):
+        self._request_call = None
+        if not self.factory.on_demand:
+            self.request_update()
+
+    def request_update(self):
+        """request an incremental update now, how on demand sessions get their frames.
+           with regions of interest the request covers their bounding box, one request per
+           update keeps the number of outstanding requests fixed, and the whole screen is
+           requested every full_refresh seconds"""
+        now = time.perf_counter()
+        self._last_request = now
+        regions = self.visible_regions()
+        if not regions or now - self._last_full_request >= self.factory.full_refresh:
+            self._last_full_request = now
+            self.framebuffer_update_request(incremental=1)
+            return
+        left = min(x for x, y, width, height in regions)
+        top = min(y for x, y, width, height in regions)
+        right = max(x + width for x, y, width, height in regions)
+        bottom = max(y + height for x, y, width, height in regions)
+        self.framebuffer_update_request(left, top, right - left, bottom - top, incremental=1)
+
+    def visible_regions(self):
+        """the regions of interest clipped to the screen"""
+        regions = []
+        for region in self.factory.regions:
+            x, y, width, height = clip_region(region, (self.width, self.height))
+            if width > 0 and height > 0:
+                regions.append((x, y, width, height))
+        return regions
+
+    def governed(self):
+        """True when the requests are paced, on demand or limited to regions of interest"""
+        return bool(self.factory.max_fps or self.factory.on_demand or self.factory.regions)
+
+    def end_of_continuous_updates(self):
+        """the first message acknowledges the encoding, continuous updates are enabled then unless
+           the requests are governed. when the server stops them later, requests take over again"""
+        if not self._continuous_updates_offered:
+            self._continuous_updates_offered = True
+            if self.factory.continuous_updates and not self.governed():
+                self.enable_continuous_updates()
+        elif self.continuous_updates:
+            self.continuous_updates = False
+            self.schedule_update_request()
+
+    def request_settings_changed(self):
+        """the max_fps, on_demand or regions setting of the factory changed, continuous updates
+           are stopped for governed requests and enabled again without them"""
+        governed = self.governed()
+        if self.continuous_updates and governed:
+            self.enable_continuous_updates(0)
+        elif self._continuous_updates_offered and self.factory.continuous_updates and not governed:
+            if not self.continuous_updates:
+                self.enable_continuous_updates()
+
+        # a scheduled request is paced again, otherwise only a stopped request chain is restarted:
+        # a request sent after the last update is still outstanding and its update requests the next
+        if self._request_call is not None:
+            self._request_call.cancel()
+            self._request_call = None
+            self.schedule_update_request()
+        elif self._last_update is not None and self._last_update >= self._last_request:
+            self.schedule_update_request()
+
+    def connectionLost(self, reason):
+        if self._request_call is not None:
+            self._request_call.cancel()
+            self._request_call = None
+        if self.buffer is not None:
+            self.buffer.update_aborted()
+        super().connectionLost(reason)
 
     def update_rectangle(self, x, y, width, height, data):
         """new bitmap data"""
         # print("%s " * 5 % (x, y, width, height, len(data)))
         # ~ log.msg("screen update")
-        self.canvas.blit(pygame.image.fromstring(data, (width, height), 'RGBX'), (x, y)) # TODO Color Format
+        pixels = self.framebuffer[y:y + height, x:x + width]
+        self.converter.convert_into(data, pixels)
+        if self.recorder is not None:
+            self.recorder.update_rectangle(x, y, width, height, self.buffer.rgb(pixels))
 
     def copy_rectangle(self, srcx, srcy, x, y, width, height):
         """copy src rectangle -> destinantion"""
         # ~ print "copyrect", (srcx, srcy, x, y, width, height)
-        self.canvas.blit(self.screen, (x, y), (srcx, srcy, width, height))
+        # numpy detects the overlap of source and destination and buffers the copy
+        self.framebuffer[y:y + height, x:x + width] = self.framebuffer[srcy:srcy + height, srcx:srcx + width]
+        if self.recorder is not None:
+            self.recorder.copy_rectangle(srcx, srcy, x, y, width, height)
 
     def fill_rectangle(self, x, y, width, height, color):
         """fill rectangle with one color"""
-        self.canvas.fill(struct.unpack("BBBB", color), (x, y, width, height))
+        color = self.converter.pixels(color)[0]
+        self.framebuffer[y:y + height, x:x + width] = color
+        if self.recorder is not None:
+            self.recorder.fill_rectangle(x, y, width, height, self.buffer.rgb(color))
 
-    def bell(self):
-        print("katsching")
+    def fill_rectangles(self, rectangles, colors):
+        """fill many rectangles with one scattered write per batch of pixels"""
+        colors = self.converter.pixels(colors)
+        if self.recorder is not None:
+            self.recorder.fill_rectangles(rectangles, self.buffer.rgb(colors))
+        screen_height, screen_width = self.framebuffer.shape[:2]
+        x, y, width, height = np.asarray(rectangles, dtype=np.intp).T
+        width = np.clip(np.minimum(x + width, screen_width) - x, 0, None)
+        height = np.clip(np.minimum(y + height, screen_height) - y, 0, None)
+        area = width * height
+        if len(area) < FILL_BATCH_MIN or area.sum() > FILL_BATCH_AREA * len(area):
+            for (x, y, width, height), color in zip(rectangles.tolist(), colors):
+                self.framebuffer[y:y + height, x:x + width] = color
+            return
 
-    def copy_text(self, text):
-        print("Clipboard: %r" % text)
+        # one element per pixel, whatever the number of bytes per pixel of the framebuffer
+        channels = self.framebuffer.shape[2]
+        pixel_dtype = np.uint32 if channels == 4 else np.dtype((np.void, channels))
+        pixels = self.framebuffer.view(pixel_dtype).reshape(-1)
+        values = np.ascontiguousarray(colors).view(pixel_dtype).reshape(-1)
+        single_color = (colors == colors[0]).all()
 
+        # split into batches of about FILL_BATCH_PIXELS to bound the size of the index arrays
+        total = np.cumsum(area)
+        bounds = np.searchsorted(total, np.arange(FILL_BATCH_PIXELS, total[-1], FILL_BATCH_PIXELS))
+        for rows in np.split(np.arange(len(area)), np.unique(bounds)):
+            owner = np.repeat(rows, area[rows])
+            offset = pyVNC.rfb.concat_ranges(np.zeros(len(rows), np.intp), area[rows])
+            index = (y[owner] + offset // width[owner]) * screen_width + x[owner] + offset % width[owner]
+            if single_color:
+                pixels[index] = values[0]
+            else:
+                # the last rectangle covering a pixel wins, independent of numpy's assignment order:
+                # owners ascend, so the first occurrence in the reversed batch is the last writer
+                index, last = np.unique(index[::-1], return_index=True)
+                pixels[index] = values[owner[::-1][last]]
 
-class RFBToGUIeightbits(RFBToGUI):
-    def vnc_connection_made(self):
-        """choose appropriate color depth, resize screen"""
-        self.remoteframebuffer = self.factory.remoteframebuffer
-        self.screen = self.remoteframebuffer.screen
-        self.remoteframebuffer.set_protocol(self)
-        self.remoteframebuffer.set_rfb_size(self.width, self.height, 8)
-        self.set_encodings(self.factory.encodings)
-        self.set_pixel_format(bpp=8, depth=8, bigendian=0, truecolor=1,
-                              redmax=7, greenmax=7, bluemax=3,
-                              redshift=5, greenshift=2, blueshift=0
-                              )
-        self.palette = self.screen.get_palette()
-        self.framebuffer_update_request()
+    def memory(self):
+        tables = sum(converter.table_bytes() for converter in {self.pixel_format, self.converter}
+                     if converter is not None)
+        return dict(super().memory(), tables=tables)
 
-    def update_rectangle(self, x, y, width, height, data):
-        bmp = pygame.image.fromstring(data, (width, height), 'P')
-        bmp.set_palette(self.palette)
-        self.screen.blit(bmp, (x, y))
+    def set_colour_map_entries(self, first, colours):
+        self.pixel_format.set_colour_map(first, colours)
+        if self.converter is not self.pixel_format:
+            self.converter.set_colour_map(first, colours)
 
-    def fill_rectangle(self, x, y, width, height, color):
-        self.screen.fill(ord(color), (x, y, width, height))
+    def bell(self):
+        print("katsching")
+
+    def copy_text(self, text):
+        print("Clipboard: %r" % text)
@@ -0,0 +1,213 @@
+import mmap
+import struct
+import time
+import zlib
+import numpy as np
+
+# A recording is a log of the rectangle operations of a session and an index of its keyframes.
+# The log starts with MAGIC, each record with its type byte. Pixels are stored as RGB,
+# a COMMIT record ends the operations of one framebuffer update.
+# KEYFRAME records hold the whole screen after the preceding commit, the index file
+# (path + ".idx") lists their (timestamp, offset) so a reader can start from the nearest one.
+MAGIC = b"pyVNC-rec-1\n"
+
+SIZE, UPDATE, COPY, FILL, FILLS, COMMIT, KEYFRAME = range(1, 8)
+
+SIZE_RECORD = struct.Struct("<BHH")  # width, height, the screen is black afterwards
+UPDATE_RECORD = struct.Struct("<BHHHHI")  # x, y, width, height, length of the zlib compressed pixels
+COPY_RECORD = struct.Struct("<BHHHHHH")  # srcx, srcy, x, y, width, height
+FILL_RECORD = struct.Struct("<BHHHH3s")  # x, y, width, height, color
+FILLS_RECORD = struct.Struct("<BI")  # number of FILL_DTYPE entries that follow
+COMMIT_RECORD = struct.Struct("<Bd")  # timestamp
+KEYFRAME_RECORD = struct.Struct("<BdHHI")  # timestamp, width, height, length of the zlib compressed pixels
+
+FILL_DTYPE = np.dtype([("x", "<u2"), ("y", "<u2"), ("width", "<u2"), ("height", "<u2"), ("color", "u1", 3)])
+INDEX_DTYPE = np.dtype([("timestamp", "<f8"), ("offset", "<u8")])
+
+
+class Recorder:
+    """Records the rectangle operations of a session, RFBToGUI calls it after applying each one.
+
+        vnc = Client(host="127.0.0.1", port=5902, record="session.rec")
+    """
+
+    def __init__(self, path, keyframe_interval=10.0, level=1):
+        self.path = path
+        self.keyframe_interval = keyframe_interval  # seconds between keyframes
+        self.level = level  # zlib compression level of the pixel data
+        self.file = open(path, "wb")
+        self.index = open(path + ".idx", "wb")
+        self.file.write(MAGIC)
+        self.last_keyframe = None  # timestamp of the last keyframe, None forces one at the next commit
+
+    def start(self, width, height):
+        """a new screen of the given size"""
+        self.file.write(SIZE_RECORD.pack(SIZE, width, height))
+        self.last_keyframe = None
+
+    def update_rectangle(self, x, y, width, height, pixels):
+        data = zlib.compress(np.ascontiguousarray(pixels[..., :3]), self.level)
+        self.file.write(UPDATE_RECORD.pack(UPDATE, x, y, width, height, len(data)))
+        self.file.write(data)
+
+    def copy_rectangle(self, srcx, srcy, x, y, width, height):
+        self.file.write(COPY_RECORD.pack(COPY, srcx, srcy, x, y, width, height))
+
+    def fill_rectangle(self, x, y, width, height, color):
+        self.file.write(FILL_RECORD.pack(FILL, x, y, width, height, bytes(color[:3])))
+
+    def fill_rectangles(self, rectangles, colors):
+        fills = np.empty(len(rectangles), dtype=FILL_DTYPE)
+        rectangles = np.asarray(rectangles)
+        for i, name in enumerate(("x", "y", "width", "height")):
+            fills[name] = rectangles[:, i]
+        fills["color"] = np.asarray(colors)[:, :3]
+        self.file.write(FILLS_RECORD.pack(FILLS, len(fills)))
+        self.file.write(fills.tobytes())
+
+    def keyframe_due(self, timestamp):
+        """True when the commit at timestamp writes a keyframe"""
+        return self.last_keyframe is None or timestamp - self.last_keyframe >= self.keyframe_interval
+
+    def commit_update(self, framebuffer, timestamp=None):
+        """end of an update, framebuffer is the screen after it. it is only read when
+           a keyframe is due and may be None otherwise"""
+        timestamp = time.time() if timestamp is None else timestamp
+        self.file.write(COMMIT_RECORD.pack(COMMIT, timestamp))
+        if self.keyframe_due(timestamp):
+            self.write_keyframe(framebuffer, timestamp)
+
+    def write_keyframe(self, framebuffer, timestamp):
+        height, width = framebuffer.shape[:2]
+        data = zlib.compress(np.ascontiguousarray(framebuffer[..., :3]), self.level)
+        offset = self.file.tell()
+        self.file.write(KEYFRAME_RECORD.pack(KEYFRAME, timestamp, width, height, len(data)))
+        self.file.write(data)
+        self.last_keyframe = timestamp
+
+        # the log is flushed first so the index never points past the written data
+        self.file.flush()
+        self.index.write(np.array([(timestamp, offset)], dtype=INDEX_DTYPE).tobytes())
+        self.index.flush()
+
+    def close(self):
+        self.file.close()
+        self.index.close()
+
+
+class Replay:
+    """Reads a recording, the log and the index are memory mapped.
+
+        replay = Replay("session.rec")
+        timestamp, array = replay.seek(replay.start + 60)  # the screen a minute into the session
+        for timestamp, array in replay.frames(start=timestamp):
+            ...
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:len(MAGIC)] != MAGIC:
+            raise ValueError("%s is not a pyVNC recording" % path)
+
+        # only complete index entries, the recorder may still be writing
+        with open(path + ".idx", "rb") as f:
+            f.seek(0, 2)
+            entries = f.tell() // INDEX_DTYPE.itemsize
+        if entries == 0:
+            raise ValueError("%s has no keyframe" % path)
+        self.index = np.memmap(path + ".idx", dtype=INDEX_DTYPE, mode="r", shape=(entries,))
+        self.timestamps = self.index["timestamp"]
+
+    @property
+    def start(self):
+        return float(self.timestamps[0])
+
+    def keyframe_offset(self, timestamp):
+        """offset of the last keyframe at or before timestamp, the first one for earlier times"""
+        i = np.searchsorted(self.timestamps, timestamp, side="right") - 1
+        return int(self.index["offset"][max(i, 0)])
+
+    def seek(self, timestamp):
+        """the (timestamp, array) of the last update committed at or before timestamp"""
+        frame = None
+        for frame in self._replay(self.keyframe_offset(timestamp), stop=timestamp):
+            pass
+        return frame[0], frame[1].copy()
+
+    def frames(self, start=None):
+        """iterate over (timestamp, array) of every update from start on.
+           the array is reused, copy it to keep it"""
+        offset = self.keyframe_offset(self.start if start is None else start)
+        for timestamp, array in self._replay(offset):
+            if start is None or timestamp >= start:
+                yield timestamp, array
+
+    def _replay(self, offset, stop=None):
+        """apply the records from the keyframe at offset, yields after each commit up to stop"""
+        array = None
+        pending = []  # operations of the update that is not yet committed
+        for record in self._records(offset):
+            kind = record[0]
+            if kind == KEYFRAME:
+                # later keyframes repeat the screen of the commit before them
+                if array is None:
+                    _, timestamp, width, height, data = record
+                    array = np.frombuffer(zlib.decompress(data), dtype=np.uint8).reshape(height, width, 3).copy()
+                    yield timestamp, array
+            elif kind == COMMIT:
+                if stop is not None and record[1] > stop:
+                    return
+                for operation in pending:
+                    array = self._apply(array, operation)
+                pending.clear()
+                yield record[1], array
+            else:
+                pending.append(record)
+
+    def _records(self, offset):
+        """parse the log from offset, a partly written last record is ignored"""
+        data = self.data
+        end = len(data)
+        formats = {SIZE: SIZE_RECORD, UPDATE: UPDATE_RECORD, COPY: COPY_RECORD, FILL: FILL_RECORD,
+                   FILLS: FILLS_RECORD, COMMIT: COMMIT_RECORD, KEYFRAME: KEYFRAME_RECORD}
+        while offset < end:
+            record_format = formats[data[offset]]
+            if offset + record_format.size > end:
+                return
+            record = record_format.unpack_from(data, offset)
+            offset += record_format.size
+
+            if record[0] in (UPDATE, KEYFRAME):
+                length = record[-1]
+            elif record[0] == FILLS:
+                length = record[1] * FILL_DTYPE.itemsize
+            else:
+                yield record
+                continue
+
+            if offset + length > end:
+                return
+            yield record[:-1] + (data[offset:offset + length],)
+            offset += length
+
+    @staticmethod
+    def _apply(array, record):
+        kind = record[0]
+        if kind == UPDATE:
+            _, x, y, width, height, data = record
+            array[y:y + height, x:x + width] = np.frombuffer(zlib.decompress(data), dtype=np.uint8).reshape(height, width, 3)
+        elif kind == COPY:
+            _, srcx, srcy, x, y, width, height = record
+            array[y:y + height, x:x + width] = array[srcy:srcy + height, srcx:srcx + width]
+        elif kind == FILL:
+            _, x, y, width, height, color = record
+            array[y:y + height, x:x + width] = np.frombuffer(color, dtype=np.uint8)
+        elif kind == FILLS:
+            for x, y, width, height, color in np.frombuffer(record[1], dtype=FILL_DTYPE).tolist():
+                array[y:y + height, x:x + width] = color
+        elif kind == SIZE:
+            _, width, height = record
+            array = np.zeros(shape=(height, width, 3), dtype=np.uint8)
+        return array
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+import argparse
+import struct
+import time
+import zlib
+import numpy as np
+from twisted.internet import protocol, reactor
+from pyVNC import Recorder
+from pyVNC.rfb import RAW_ENCODING, COPY_RECTANGLE_ENCODING, RRE_ENCODING
+import logging
+logger = logging.getLogger("pyVNC")
+
+# A capture holds the server -> client bytes of a session from the ServerInit message on,
+# split into the chunks the client received: CHUNK header (receive time, length) followed by the bytes.
+# The magic is followed by the pixel format the client set with SetPixelFormat, all zero when it kept
+# the one of the ServerInit. Readers put it into the ServerInit, so the stream matches its pixels.
+# Captures of the first version (CAPTURE_MAGIC_1) have no pixel format.
+CAPTURE_MAGIC = b"pyVNC-cap-2\n"
+CAPTURE_MAGIC_1 = b"pyVNC-cap-1\n"
+CHUNK = struct.Struct("<dI")
+PIXEL_FORMAT_SIZE = 16
+
+# pixel format the replay of a recording announces: 32 bits, little endian, RGBX bytes
+PIXEL_FORMAT = struct.pack("!BBBBHHHBBBxxx", 32, 24, 0, 1, 255, 255, 255, 0, 8, 16)
+
+# rectangles per FramebufferUpdate message, the count is 16 bits
+MAX_RECTANGLES = 0xffff
+
+
+class StreamCapture:
+    """Writes the bytes an RFBClient receives to a capture file.
+
+        vnc = Client(host="127.0.0.1", port=5902, capture="session.cap")
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "wb")
+        self.file.write(CAPTURE_MAGIC)
+        self.file.write(bytes(PIXEL_FORMAT_SIZE))
+
+    def set_pixel_format(self, pixel_format):
+        """the 16 byte pixel format the client asked the server for"""
+        self.file.seek(len(CAPTURE_MAGIC))
+        self.file.write(pixel_format)
+        self.file.seek(0, 2)
+
+    def write(self, data):
+        if len(data):
+            self.file.write(CHUNK.pack(time.time(), len(data)))
+            self.file.write(data)
+
+    def close(self):
+        self.file.close()
+
+
+def capture_chunks(path):
+    """(timestamp, bytes) of a capture file, the ServerInit carries the pixel format of the session"""
+    with open(path, "rb") as f:
+        pixel_format = None
+        if f.read(len(CAPTURE_MAGIC)) == CAPTURE_MAGIC:
+            pixel_format = f.read(PIXEL_FORMAT_SIZE)
+            if not any(pixel_format):
+                pixel_format = None
+        position = 0  # of the chunk in the stream, the pixel format is at 4 to 20 of the ServerInit
+        while True:
+            header = f.read(CHUNK.size)
+            if len(header) < CHUNK.size:
+                return
+            timestamp, length = CHUNK.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            if pixel_format is not None and position < 4 + PIXEL_FORMAT_SIZE:
+                data = bytearray(data)
+                start, stop = max(4 - position, 0), min(4 + PIXEL_FORMAT_SIZE - position, len(data))
+                if start < stop:
+                    data[start:stop] = pixel_format[position + start - 4:position + stop - 4]
+                data = bytes(data)
+            position += length
+            yield timestamp, data
+
+
+def recording_chunks(path, name=b"pyVNC replay"):
+    """(timestamp, bytes) of the RFB messages that redraw a Recorder log: a ServerInit
+       and one FramebufferUpdate per commit, with raw, CopyRect and RRE rectangles"""
+    replay = Recorder.Replay(path)
+    rectangles = []
+    size = None
+    for record in replay._records(len(Recorder.MAGIC)):
+        kind = record[0]
+        if kind == Recorder.SIZE:
+            if size is None:
+                size = record[1:]
+                yield None, struct.pack("!HH16sI", *size, PIXEL_FORMAT, len(name)) + name
+        elif kind == Recorder.UPDATE:
+            _, x, y, width, height, data = record
+            pixels = np.zeros(shape=(height, width, 4), dtype=np.uint8)
+            pixels[..., :3] = np.frombuffer(zlib.decompress(data), dtype=np.uint8).reshape(height, width, 3)
+            rectangles.append(struct.pack("!HHHHi", x, y, width, height, RAW_ENCODING) + pixels.tobytes())
+        elif kind == Recorder.COPY:
+            _, srcx, srcy, x, y, width, height = record
+            rectangles.append(struct.pack("!HHHHiHH", x, y, width, height, COPY_RECTANGLE_ENCODING, srcx, srcy))
+        elif kind == Recorder.FILL:
+            rectangles.append(_fill(*record[1:]))
+        elif kind == Recorder.FILLS:
+            for x, y, width, height, color in np.frombuffer(record[1], dtype=Recorder.FILL_DTYPE).tolist():
+                rectangles.append(_fill(x, y, width, height, bytes(color)))
+        elif kind == Recorder.COMMIT:
+            for start in range(0, max(len(rectangles), 1), MAX_RECTANGLES):
+                batch = rectangles[start:start + MAX_RECTANGLES]
+                yield record[1], struct.pack("!BxH", 0, len(batch)) + b"".join(batch)
+            rectangles = []
+
+
+def _fill(x, y, width, height, color):
+    """a rectangle of one color as RRE without subrectangles"""
+    return struct.pack("!HHHHiI", x, y, width, height, RRE_ENCODING, 0) + bytes(color) + b"\x00"
+
+
+def open_source(path):
+    """chunk iterator factory for a capture or a recording"""
+    with open(path, "rb") as f:
+        magic = f.read(max(len(CAPTURE_MAGIC), len(Recorder.MAGIC)))
+    if magic.startswith(CAPTURE_MAGIC) or magic.startswith(CAPTURE_MAGIC_1):
+        return lambda: capture_chunks(path)
+    elif magic.startswith(Recorder.MAGIC):
+        return lambda: recording_chunks(path)
+    raise ValueError("%s is neither a capture nor a recording" % path)
+
+
+class ReplayServerProtocol(protocol.Protocol):
+    """Performs the RFB 3.3 handshake without authentication and streams the chunks,
+       the messages of the client are ignored. Clients keep the pixel format of the stream
+       with Client(native_format=True)"""
+
+    def connectionMade(self):
+        self.received = b""
+        self.state = self._handle_version
+        self.chunks = None
+        self.next_chunk = None  # chunk that waits for its time
+        self.delayed = None
+        self.started = None  # (local time, stream time) of the first chunk
+        self.transport.write(b"RFB 003.003\n")
+
+    def dataReceived(self, data):
+        self.received += data
+        self.state()
+
+    def _handle_version(self):
+        if len(self.received) >= 12:
+            self.received = self.received[12:]
+            self.transport.write(struct.pack("!I", 1))  # no authentication
+            self.state = self._handle_client_init
+            self.state()
+
+    def _handle_client_init(self):
+        if len(self.received) >= 1:
+            self.received = b""
+            self.state = self._ignore
+            self.chunks = self.factory.source()
+            if self.factory.paced:
+                self.send_paced()
+            else:
+                self.transport.registerProducer(self, False)
+
+    def _ignore(self):
+        self.received = b""
+
+    def resumeProducing(self):
+        """full speed, the transport asks for the next chunk when its buffer is drained"""
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.transport.unregisterProducer()
+            self.finished()
+        else:
+            self.transport.write(chunk[1])
+
+    def stopProducing(self):
+        self.chunks = iter(())
+
+    def send_paced(self):
+        """original pacing, each chunk is sent at its recorded time relative to the first one"""
+        self.delayed = None
+        while True:
+            chunk, self.next_chunk = self.next_chunk or next(self.chunks, None), None
+            if chunk is None:
+                self.finished()
+                return
+
+            timestamp, data = chunk
+            if timestamp is not None:
+                if self.started is None:
+                    self.started = (time.time(), timestamp)
+                delay = self.started[0] + (timestamp - self.started[1]) / self.factory.speed - time.time()
+                if delay > 0:
+                    self.next_chunk = chunk
+                    self.delayed = reactor.callLater(delay, self.send_paced)
+                    return
+            self.transport.write(data)
+
+    def finished(self):
+        logger.info("replay finished")
+        if self.factory.close_when_done:
+            self.transport.loseConnection()
+
+    def connectionLost(self, reason):
+        if self.delayed is not None and self.delayed.active():
+            self.delayed.cancel()
+
+
+class ReplayServerFactory(protocol.ServerFactory):
+    """Serves a capture or a recording to every client that connects.
+
+        reactor.listenTCP(5902, ReplayServerFactory("session.cap"))
+    """
+    protocol = ReplayServerProtocol
+
+    def __init__(self, path, paced=False, speed=1.0, close_when_done=True):
+        self.source = open_source(path)
+        self.paced = paced  # keep the recorded timing instead of sending at full speed
+        self.speed = speed  # time scale of the paced replay
+        self.close_when_done = close_when_done
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", type=str, help="Capture or recording to serve")
+    parser.add_argument("--port", default=5902, type=int, help="TCP port to listen on")
+    parser.add_argument("--paced", action="store_true", help="Keep the recorded timing")
+    parser.add_argument("--speed", default=1.0, type=float, help="Time scale of the paced replay")
+    parser.add_argument("--keep-open", action="store_true", help="Keep the connection open after the replay")
+    args = parser.parse_args()
+
+    reactor.listenTCP(args.port, ReplayServerFactory(args.path, args.paced, args.speed, not args.keep_open))
+    reactor.run()
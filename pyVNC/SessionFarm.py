@@ -0,0 +1,433 @@
+from threading import Thread, Event, Lock, Condition
+from concurrent.futures import Future
+import itertools
+import time
+from multiprocessing import shared_memory, resource_tracker
+import multiprocessing
+import os
+import numpy as np
+from pyVNC.SessionPool import SessionPool, Session, SessionBuffer
+from pyVNC.Buffer import CompactBuffer, Frame, FRONT_BUFFERS, clip_region
+from pyVNC.VNCFactory import VNCFactory
+import logging
+logger = logging.getLogger("pyVNC")
+
+# Session methods the parent may call in a worker
+COMMANDS = {"send_key", "send_press", "send_release", "send_mouse", "set_quality", "set_frame_rate", "request_update",
+            "set_regions", "close"}
+
+# Session methods whose result the parent may ask a worker for
+QUERIES = {"fps", "stats", "memory"}
+
+# seconds a query waits for the reply of the worker
+QUERY_TIMEOUT = 5.0
+
+# seconds between checks of the shared header while waiting for a frame, in case a frame event was missed
+FRAME_POLL = 0.05
+
+# A shared framebuffer segment is a HEADER followed by FRONT_BUFFERS RGB fronts. The worker publishes
+# an update by writing the header between two increments of lock (odd while it is written), the
+# parent reads it again when lock changed in between. front_seqs is -1 while a front is written.
+# waiting is written by the parent, the worker reports a "frame" event per update while it is not 0.
+HEADER_DTYPE = np.dtype([("lock", "<u8"), ("seq", "<u8"), ("timestamp", "<f8"), ("front", "<u8"),
+                         ("front_seqs", "<i8", (FRONT_BUFFERS,)), ("waiting", "<u8")])
+
+
+def _close(shm):
+    """unmap a shared memory segment, it stays mapped while views of it are still in use"""
+    try:
+        shm.close()
+    except BufferError:
+        pass
+
+
+class SharedArrayBuffer(SessionBuffer):
+    """SessionBuffer whose RGB array lives in shared memory.
+       The worker creates the memory, the parent process attaches to it and unlinks it."""
+
+    def __init__(self, index, report):
+        super().__init__()
+        self.index = index
+        self.report = report  # sends an event to the parent process
+        self.shm = None
+        self.header = None  # HEADER_DTYPE record at the start of the segment
+
+    def set_rfb_size(self, width, height, depth=32):
+        super().set_rfb_size(width, height, depth)
+        size = HEADER_DTYPE.itemsize + FRONT_BUFFERS * width * height * 3
+        previous = None
+        if self.shm is None or self.shm.size < size:
+            previous, self.shm = self.shm, shared_memory.SharedMemory(create=True, size=size)
+            # the parent owns the segment: it registers it with its resource tracker when it
+            # attaches and unregisters it when it unlinks it, the worker keeps no registration
+            resource_tracker.unregister(self.shm._name, "shared_memory")
+        self.header = np.ndarray(shape=(), dtype=HEADER_DTYPE, buffer=self.shm.buf)
+        fronts = np.ndarray(shape=(FRONT_BUFFERS, height, width, 3), dtype=np.uint8, buffer=self.shm.buf,
+                            offset=HEADER_DTYPE.itemsize)
+        fronts[:] = 0
+        self.set_fronts(list(fronts))
+        self.write_header()
+        # the parent unlinks the previous segment when it attached to the new one
+        if previous is not None:
+            _close(previous)
+        self.report(("ready", self.index, self.shm.name, width, height))
+
+    def write_header(self):
+        header = self.header
+        header["lock"] += 1
+        header["seq"] = self.seq
+        header["timestamp"] = self.timestamp or 0.0
+        header["front"] = self._front
+        header["front_seqs"] = self.front_seqs
+        header["lock"] += 1
+
+    def refresh_array(self, rectangles):
+        # the parent must see that the front is being written before it is
+        header = self.header
+        header["lock"] += 1
+        header["front_seqs"][(self._front + 1) % len(self.fronts)] = -1
+        header["lock"] += 1
+        super().refresh_array(rectangles)
+
+    def publish(self):
+        super().publish()
+        self.write_header()
+        if self.header["waiting"]:
+            self.report(("frame", self.index, self.seq))
+
+
+class SharedCompactBuffer(SharedArrayBuffer, CompactBuffer):
+    """SharedArrayBuffer whose framebuffer in the worker has the compact layout of a CompactBuffer,
+       the fronts are filled from it in RGB"""
+
+
+class FarmWorkerSession(Session):
+    """Session of a farm worker, connection errors are reported to the parent process"""
+
+    def connection_failed(self, error):
+        super().connection_failed(error)
+        self.screen.report(("error", self.screen.index, error))
+
+
+def run_worker(conn):
+    """worker process: runs a SessionPool and executes the commands of the parent"""
+    pool = SessionPool()
+    sessions = {}
+    send_lock = Lock()
+
+    def report(event):
+        with send_lock:
+            conn.send(event)
+
+    def read_commands():
+        while True:
+            try:
+                command = conn.recv()
+            except (EOFError, OSError):
+                command = ("stop",)  # the parent is gone
+
+            if command[0] == "add":
+                _, index, kwargs = command
+                compact = kwargs.pop("compact")
+                screen = (SharedCompactBuffer if compact else SharedArrayBuffer)(index, report)
+                sessions[index] = pool.add_session(FarmWorkerSession(screen=screen, **kwargs))
+            elif command[0] == "call":
+                _, index, method, args = command
+                if method in COMMANDS:
+                    getattr(sessions[index], method)(*args)
+            elif command[0] == "query":
+                _, request, index, method, args = command
+                try:
+                    if method not in QUERIES:
+                        raise ValueError("%s can not be queried" % method)
+                    report(("reply", request, getattr(sessions[index], method)(*args), None))
+                except Exception as error:
+                    report(("reply", request, None, repr(error)))
+            elif command[0] == "stop":
+                pool.stop()
+                return
+
+    Thread(target=read_commands, daemon=True).start()
+    pool.run_block()
+
+
+class FarmSession:
+    """A session of a SessionFarm as seen by the parent process.
+       get_array returns a view of the last complete front in shared memory, no copy is made.
+       As with a Buffer, the front is not written before FRONT_BUFFERS - 1 more updates completed."""
+
+    def __init__(self, farm, index, worker, kwargs):
+        self.farm = farm
+        self.index = index
+        self.worker = worker
+        self.kwargs = kwargs
+        self.host = kwargs["host"]
+        self.port = kwargs["port"]
+        self.ready = Event()
+        self.error = None
+        self.shm = None
+        self.header = None
+        self.fronts = None
+        self.frame_condition = Condition()  # notified by the frame events of the worker
+        self._waiting = 0  # threads in wait_for_frame
+
+    def attach(self, name, width, height):
+        """map the shared framebuffer the worker created, a resize replaces the previous one"""
+        previous = self.shm
+        self.shm = shared_memory.SharedMemory(name=name)
+        self.header = np.ndarray(shape=(), dtype=HEADER_DTYPE, buffer=self.shm.buf)
+        self.fronts = np.ndarray(shape=(FRONT_BUFFERS, height, width, 3), dtype=np.uint8, buffer=self.shm.buf,
+                                 offset=HEADER_DTYPE.itemsize)
+        with self.frame_condition:
+            self.header["waiting"] = self._waiting
+            self.frame_condition.notify_all()
+        if previous is not None:
+            if previous.name != name:
+                previous.unlink()
+            _close(previous)
+        self.ready.set()
+
+    def connection_failed(self, error):
+        self.error = error
+        self.ready.set()
+
+    def release(self):
+        """remove the shared framebuffer, existing views stay valid until they are dropped"""
+        if self.shm is not None:
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
+            _close(self.shm)
+
+    def wait_ready(self, timeout=None):
+        """block until the session is initialized, False on timeout"""
+        ready = self.ready.wait(timeout)
+        if self.error is not None:
+            raise ConnectionError("Could not connect to %s:%s: %s" % (self.host, self.port, self.error))
+        return ready
+
+    def _read_header(self):
+        """a consistent copy of the header, None before the session is ready"""
+        header = self.header
+        if header is None:
+            return None
+        while True:
+            lock = int(header["lock"])
+            if lock % 2 == 0:
+                copy = header.copy()
+                if int(header["lock"]) == lock:
+                    return copy
+            time.sleep(0)
+
+    def get_frame(self):
+        """the last published frame. the rectangles of the updates are not shared, frames of a farm
+           session list the whole screen"""
+        header = self._read_header()
+        if header is None:
+            return Frame(0, None, None, [])
+        array = self.fronts[int(header["front"])]
+        height, width = array.shape[:2]
+        return Frame(int(header["seq"]), float(header["timestamp"]) or None, array, [(0, 0, width, height)])
+
+    def frame_intact(self, frame):
+        """True while the array of the frame still holds the pixels of that update"""
+        header = self._read_header()
+        for front, seq in zip(self.fronts, header["front_seqs"]):
+            if front.ctypes.data == frame.array.ctypes.data:
+                return int(seq) == frame.seq
+        return False
+
+    def get_array(self):
+        return self.get_frame().array
+
+    @property
+    def seq(self):
+        """number of completed updates"""
+        header = self._read_header()
+        return 0 if header is None else int(header["seq"])
+
+    def frame_event(self):
+        with self.frame_condition:
+            self.frame_condition.notify_all()
+
+    def wait_for_frame(self, after_seq=None, timeout=None):
+        """block until an update newer than after_seq (default: the current one) completed.
+           returns the Frame or None on timeout"""
+        deadline = None if timeout is None else time.time() + timeout
+        with self.frame_condition:
+            if after_seq is None:
+                after_seq = self.seq
+            self._set_waiting(1)
+            try:
+                while self.seq <= after_seq:
+                    remaining = FRAME_POLL if deadline is None else min(deadline - time.time(), FRAME_POLL)
+                    if remaining <= 0:
+                        return None
+                    self.frame_condition.wait(remaining)
+            finally:
+                self._set_waiting(-1)
+        return self.get_frame()
+
+    def _set_waiting(self, change):
+        """count a waiting thread in and out, the worker only reports frames while there are any"""
+        self._waiting += change
+        if self.header is not None:
+            self.header["waiting"] = self._waiting
+
+    def fps(self):
+        """measured updates per second"""
+        return self._query("fps")
+
+    def stats(self):
+        """snapshot of the connection metrics, None unless the session was created with metrics=True"""
+        return self._query("stats")
+
+    def memory(self):
+        """bytes of the session's framebuffer, screen arrays and connection in the worker"""
+        return self._query("memory")
+
+    def _call(self, method, *args):
+        self.farm.send(self.worker, ("call", self.index, method, args))
+
+    def _query(self, method, *args):
+        return self.farm.query(self.worker, self.index, method, args).result(QUERY_TIMEOUT)
+
+    def send_key(self, key, duration=0.001):
+        self._call("send_key", key, duration)
+
+    def send_press(self, key):
+        self._call("send_press", key)
+
+    def send_release(self, key):
+        self._call("send_release", key)
+
+    def send_mouse(self, event="Left", position=(0, 0)):
+        self._call("send_mouse", event, tuple(position))
+
+    def set_quality(self, jpeg_quality=None, compress_level=None):
+        self._call("set_quality", jpeg_quality, compress_level)
+
+    def set_frame_rate(self, max_fps=None, on_demand=False):
+        self._call("set_frame_rate", max_fps, on_demand)
+
+    def request_update(self):
+        self._call("request_update")
+
+    def set_regions(self, regions):
+        self._call("set_regions", [tuple(region) for region in regions])
+
+    def get_region(self, region):
+        """the region (x, y, width, height) of the shared framebuffer, a view without copy"""
+        array = self.get_array()
+        x, y, width, height = clip_region(region, array.shape[1::-1])
+        return array[y:y + height, x:x + width]
+
+    def close(self):
+        self._call("close")
+
+
+class SessionFarm:
+    """Shards VNC sessions over worker processes, each running a SessionPool.
+       The framebuffers are shared memory, input is sent to the workers over a pipe.
+
+        farm = SessionFarm(workers=8)
+        sessions = [farm.add(host="127.0.0.1", port=5900 + i) for i in range(200)]
+        farm.start()
+        sessions[0].wait_ready()
+        sessions[0].send_key("a")
+        sessions[0].get_array()  # numpy view of the shared framebuffer
+        farm.stop()
+    """
+
+    def __init__(self, workers=None):
+        self.workers = workers or os.cpu_count()
+        self.context = multiprocessing.get_context("spawn")
+        self.sessions = []
+        self.processes = []
+        self.connections = []
+        self.send_locks = [Lock() for _ in range(self.workers)]
+        self.listeners = []
+        self.pending = []  # commands sent once the workers run
+        self.replies = {}  # request number -> Future of a query
+        self._requests = itertools.count()
+
+    def add(self, host="127.0.0.1", password=None, port=5902, compact=False, **options):
+        """create a session on the next worker, it connects once the farm runs. The options are those
+           of SessionPool.add, compact sessions keep a compact framebuffer in the worker while the
+           shared screen arrays stay RGB"""
+        if "regions" in options:
+            options["regions"] = tuple(tuple(region) for region in options["regions"])
+        VNCFactory(None, password=password, **options)  # unknown or invalid options raise here and not in the worker
+        kwargs = dict(host=host, password=password, port=port, compact=compact, **options)
+        index = len(self.sessions)
+        session = FarmSession(self, index, index % self.workers, kwargs)
+        self.sessions.append(session)
+        self.send(session.worker, ("add", index, kwargs))
+        return session
+
+    def send(self, worker, command):
+        if not self.connections:
+            self.pending.append((worker, command))
+            return
+        with self.send_locks[worker]:
+            self.connections[worker].send(command)
+
+    def query(self, worker, index, method, args=()):
+        """ask a worker for the result of a session method, returns a Future"""
+        request = next(self._requests)
+        future = self.replies[request] = Future()
+        self.send(worker, ("query", request, index, method, args))
+        return future
+
+    def start(self):
+        for worker in range(self.workers):
+            conn, child_conn = self.context.Pipe()
+            process = self.context.Process(target=run_worker, args=(child_conn,), daemon=True)
+            process.start()
+            child_conn.close()
+            listener = Thread(target=self.listen, args=(conn,), daemon=True)
+            listener.start()
+            self.processes.append(process)
+            self.connections.append(conn)
+            self.listeners.append(listener)
+
+        pending, self.pending = self.pending, []
+        for worker, command in pending:
+            self.send(worker, command)
+
+    def listen(self, conn):
+        """handle the events of one worker"""
+        while True:
+            try:
+                event = conn.recv()
+            except (EOFError, OSError):
+                return
+
+            if event[0] == "reply":
+                _, request, result, error = event
+                future = self.replies.pop(request)
+                if error is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(RuntimeError(error))
+                continue
+
+            session = self.sessions[event[1]]
+            if event[0] == "ready":
+                session.attach(*event[2:])
+            elif event[0] == "frame":
+                session.frame_event()
+            elif event[0] == "error":
+                session.connection_failed(event[2])
+
+    def stop(self, timeout=5):
+        """stop the workers and remove the shared framebuffers"""
+        for worker in range(len(self.connections)):
+            self.send(worker, ("stop",))
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+        for session in self.sessions:
+            session.release()
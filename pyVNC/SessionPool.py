@@ -0,0 +1,312 @@
+from threading import Thread, Event
+from concurrent.futures import Future
+import asyncio
+from twisted.internet import reactor
+import pygame
+from pyVNC.constants import keysym, text_keysyms
+from pyVNC.Buffer import ArrayBuffer, CompactBuffer
+from pyVNC.VNCFactory import VNCFactory
+from pyVNC.rfb import ENCODING_NAMES, KEY_EVENT_DTYPE, key_event_messages
+import logging
+logger = logging.getLogger("pyVNC")
+
+
+class SessionBuffer(ArrayBuffer):
+    """ArrayBuffer that signals when the session has its screen size"""
+
+    def __init__(self):
+        super().__init__()
+        self.ready = Event()
+
+    def set_rfb_size(self, width, height, depth=32):
+        super().set_rfb_size(width, height, depth)
+        self.ready.set()
+
+
+class CompactSessionBuffer(CompactBuffer):
+    """CompactBuffer that signals when the session has its screen size"""
+
+    def __init__(self):
+        super().__init__()
+        self.ready = Event()
+
+    def set_rfb_size(self, width, height, depth=32):
+        super().set_rfb_size(width, height, depth)
+        self.ready.set()
+
+
+class SessionFactory(VNCFactory):
+    """VNCFactory of a pooled session, a failing session must not stop the shared reactor"""
+
+    def __init__(self, session, *args, **kwargs):
+        VNCFactory.__init__(self, session.screen, *args, **kwargs)
+        self.session = session
+
+    def clientConnectionLost(self, connector, reason):
+        self.session.screen.ready.clear()
+        if self.session.closed:
+            return
+        logger.error("Connection to %s:%s lost: %r" % (self.session.host, self.session.port, reason.getErrorMessage()))
+        logger.error("Attempting to reconnect")
+        connector.connect()
+
+    def clientConnectionFailed(self, connector, reason):
+        logger.error("Could not connect to %s:%s with reason: %r" % (self.session.host, self.session.port, reason.getErrorMessage()))
+        self.session.connection_failed(reason.getErrorMessage())
+
+
+class SessionMixin:
+    """The methods Client and Session share, they use the screen buffer and the factory of the connection.
+       The methods may be called from any thread, protocol calls are passed to the reactor thread."""
+
+    screen = None
+    factory = None
+
+    def _key_event(self, key, down):
+        if self.screen.protocol is not None:
+            self.screen.protocol.key_event(key, down)
+
+    def _pointer_event(self, x, y, buttonmask):
+        if self.screen.protocol is not None:
+            self.screen.protocol.pointer_event(x, y, buttonmask)
+
+    def send_key(self, key, duration=0.001):
+        """press and release a key, the release is scheduled in the reactor so the caller does not block"""
+        key = keysym(key)
+        reactor.callFromThread(self._key_event, key, 1)
+        reactor.callFromThread(reactor.callLater, duration, self._key_event, key, 0)
+
+    def send_press(self, key):
+        reactor.callFromThread(self._key_event, keysym(key), 1)
+
+    def send_release(self, key):
+        reactor.callFromThread(self._key_event, keysym(key), 0)
+
+    def send_text(self, text, interval=0.005):
+        """type text without blocking, each character is pressed and released interval seconds after the
+           previous one, all of them in a single write when interval is 0.
+           returns a concurrent.futures.Future that completes when the last release is sent"""
+        messages = key_event_messages(text_keysyms(text))
+        future = Future()
+        reactor.callFromThread(self._send_key_events, messages, interval, future, 0)
+        return future
+
+    def _send_key_events(self, messages, interval, future, offset):
+        if future.cancelled():
+            return
+        if self.screen.protocol is None:
+            future.set_exception(ConnectionError("not connected"))
+            return
+
+        # a press and its release
+        end = len(messages) if not interval else offset + 2 * KEY_EVENT_DTYPE.itemsize
+        self.screen.protocol.key_events(messages[offset:end])
+        if end >= len(messages):
+            future.set_result(None)
+        else:
+            reactor.callLater(interval, self._send_key_events, messages, interval, future, end)
+
+    def send_mouse(self, event="Left", position=(0, 0)):
+        # Left 1, Middle 2, Right 4
+        button_id = {"Left": 1, "Middle": 2, "Right": 4}.get(event)
+        reactor.callFromThread(self._pointer_event, position[0], position[1], 0)
+        reactor.callFromThread(self._pointer_event, position[0], position[1], button_id)
+
+    def get_array(self):
+        return self.screen.get_array()
+
+    def get_rectangles(self):
+        return self.screen.get_rectangles()
+
+    def memory(self):
+        """bytes of the session's framebuffer and screen arrays"""
+        return self.screen.memory()
+
+    def stats(self):
+        """snapshot of the connection metrics, None unless the session was created with metrics=True"""
+        protocol = self.screen.protocol
+        if protocol is None or protocol.metrics is None:
+            return None
+        return protocol.metrics.snapshot(ENCODING_NAMES)
+
+    def fps(self):
+        """measured updates per second"""
+        return self.screen.fps()
+
+    def wait_for_frame(self, after_seq=None, timeout=None):
+        """block until an update newer than after_seq (default: the current one) is complete.
+           returns a Frame(seq, timestamp, array, rectangles) or None on timeout"""
+        return self.screen.wait_for_frame(after_seq, timeout)
+
+    def frames(self, timeout=None):
+        """iterate over the completed updates, updates that complete while the caller is busy are skipped"""
+        seq = self.screen.seq
+        while True:
+            frame = self.screen.wait_for_frame(seq, timeout)
+            if frame is None:
+                return
+            seq = frame.seq
+            yield frame
+
+    async def wait_for_frame_async(self, after_seq=None):
+        """wait_for_frame for asyncio code, no thread is blocked while waiting"""
+        future = asyncio.get_running_loop().create_future()
+        self.screen.add_frame_waiter(asyncio.get_running_loop(), future, after_seq)
+        return await future
+
+    async def aframes(self):
+        """async iterator over the completed updates"""
+        seq = self.screen.seq
+        while True:
+            frame = await self.wait_for_frame_async(seq)
+            seq = frame.seq
+            yield frame
+
+    def set_quality(self, jpeg_quality=None, compress_level=None):
+        """Change the tight JPEG quality and compression level (0-9) of the session"""
+        self.factory.set_quality(jpeg_quality, compress_level)
+        reactor.callFromThread(self._set_encodings)
+
+    def _set_encodings(self):
+        if self.screen.protocol is not None:
+            self.screen.protocol.set_encodings(self.factory.encodings)
+
+    def set_frame_rate(self, max_fps=None, on_demand=False):
+        """Limit the update rate to max_fps, or only request updates in request_update()"""
+        self.factory.max_fps = max_fps
+        self.factory.on_demand = on_demand
+        reactor.callFromThread(self._request_settings_changed)
+
+    def _request_settings_changed(self):
+        if self.screen.protocol is not None:
+            self.screen.protocol.request_settings_changed()
+
+    def request_update(self):
+        """Request one update, wait for it with wait_for_frame"""
+        reactor.callFromThread(self._request_update)
+
+    def _request_update(self):
+        if self.screen.protocol is not None:
+            self.screen.protocol.request_update()
+
+    @property
+    def regions(self):
+        """the regions of interest (x, y, width, height)"""
+        return self.factory.regions
+
+    def set_regions(self, regions):
+        """Limit the incremental update requests to the regions of interest (x, y, width, height),
+           the whole screen is still requested every full_refresh seconds. No regions watch the whole screen"""
+        self.factory.regions = tuple(tuple(region) for region in regions)
+        reactor.callFromThread(self._request_settings_changed)
+
+    def add_region(self, x, y, width, height):
+        region = (x, y, width, height)
+        self.set_regions(self.factory.regions + (region,))
+        return region
+
+    def remove_region(self, region):
+        self.set_regions([r for r in self.factory.regions if r != tuple(region)])
+
+    def get_region(self, region):
+        """the region (x, y, width, height) of the screen array, a view without copy
+           or a new array of only the region for compact sessions"""
+        return self.screen.get_region(region)
+
+    def wait_for_region(self, region, after_seq=None, timeout=None):
+        """block until an update newer than after_seq changed the region. returns a Frame whose array
+           is a view of the region and whose rectangles are relative to it, or None on timeout"""
+        return self.screen.wait_for_region(region, after_seq, timeout)
+
+
+class Session(SessionMixin):
+    """One VNC connection of a SessionPool.
+       The options (depth, fast, shared, jpeg_quality, metrics, ...) are those of VNCFactory."""
+
+    def __init__(self, host="127.0.0.1", password=None, port=5902, screen=None, compact=False, **options):
+        self.host = host
+        self.port = port
+        if screen is None:
+            screen = CompactSessionBuffer() if compact else SessionBuffer()
+        self.screen = screen
+        self.factory = SessionFactory(self, password=password, **options)
+        self.connector = None
+        self.closed = False
+        self.error = None  # reason the connection could not be made
+
+    def connect(self):
+        """open the connection, runs in the reactor thread"""
+        self.connector = reactor.connectTCP(self.host, self.port, self.factory)
+
+    def connection_failed(self, error):
+        self.error = error
+        self.closed = True
+        self.screen.ready.set()  # wake wait_ready
+
+    def wait_ready(self, timeout=None):
+        """block until the session is initialized, False on timeout"""
+        ready = self.screen.ready.wait(timeout)
+        if self.error is not None:
+            raise ConnectionError("Could not connect to %s:%s: %s" % (self.host, self.port, self.error))
+        return ready
+
+    def close(self):
+        reactor.callFromThread(self._close)
+
+    def _close(self):
+        self.closed = True
+        if self.connector is not None:
+            self.connector.disconnect()
+
+
+class SessionPool(Thread):
+    """Runs many VNC sessions on one reactor thread.
+
+        pool = SessionPool()
+        sessions = [pool.add(host="127.0.0.1", port=5900 + i) for i in range(50)]
+        pool.start()
+        sessions[0].wait_ready()
+        sessions[0].send_key("a")
+        sessions[0].get_array()
+        pool.stop()
+
+    The twisted reactor can only run once per process, so there is one pool per process
+    and it can not be combined with a Client.
+    """
+
+    def __init__(self):
+        Thread.__init__(self)
+        pygame.init()
+        self.sessions = []
+
+    def add(self, host="127.0.0.1", password=None, port=5902, **options):
+        """create a session, it connects once the pool runs. The options are those of Session and
+           VNCFactory, compact sessions keep a single framebuffer in a compact layout and build the
+           screen array on each read"""
+        return self.add_session(Session(host, password, port, **options))
+
+    def add_session(self, session):
+        self.sessions.append(session)
+        reactor.callFromThread(session.connect)
+        return session
+
+    def memory(self):
+        """bytes of the framebuffers and screen arrays of all sessions"""
+        return sum(session.memory()["total"] for session in self.sessions)
+
+    def remove(self, session):
+        """close the session and drop it from the pool"""
+        session.close()
+        self.sessions.remove(session)
+
+    def stop(self):
+        """close all sessions and stop the reactor"""
+        for session in self.sessions:
+            session.close()
+        reactor.callFromThread(reactor.stop)
+
+    def run_block(self):
+        reactor.run(installSignalHandlers=False)
+
+    def run(self):
+        self.run_block()
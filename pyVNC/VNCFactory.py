@@ -1,39 +1,76 @@
 import pygame
 from twisted.internet import reactor
-from pyVNC.RFBToGUI import RFBToGUIeightbits, RFBToGUI
+from pyVNC.RFBToGUI import RFBToGUI
+from pyVNC.PixelFormat import PIXEL_FORMATS
 from pyVNC.rfb import *
 import logging
 logger = logging.getLogger("pyVNC")
 
 
 class VNCFactory(RFBFactory):
-    """A factory for remote frame buffer connections."""
+    """A factory for remote frame buffer connections.
+       Client, Session, SessionPool.add and SessionFarm.add pass their connection options on to it."""
 
-    def __init__(self, buffer, depth, fast, *args, **kwargs):
-        RFBFactory.__init__(self, *args, **kwargs)
+    def __init__(self, buffer, depth=32, fast=False, password=None, shared=True, jpeg_quality=None,
+                 compress_level=None, recorder=None, capture=None, metrics=False, pipeline=1,
+                 continuous_updates=False, max_fps=None, on_demand=False, regions=(), full_refresh=10.0,
+                 native_format=False):
+        RFBFactory.__init__(self, password, int(shared))
         self.buffer = buffer
+        self.recorder = recorder  # Recorder of the session or None
+        self.capture = capture  # StreamCapture of the received bytes or None
+        self.metrics = metrics  # collect Metrics on the connection
+        if pipeline < 1:
+            raise ValueError("at least one update request must be outstanding")
+        self.pipeline = pipeline  # incremental update requests kept outstanding
+        self.continuous_updates = continuous_updates  # let the server push updates when it supports it
+        self.max_fps = max_fps  # upper limit of the update rate or None
+        self.on_demand = on_demand  # only request updates when the application asks
+        self.regions = tuple(regions)  # regions of interest, replaced as a whole
+        self.full_refresh = full_refresh  # seconds between requests of the whole screen while there are regions
+        self.native_format = native_format  # keep the server's pixel format and convert on the client
 
-        if depth == 32:
-            self.protocol = RFBToGUI
-        elif depth == 8:
-            self.protocol = RFBToGUIeightbits
-        else:
+        if depth not in PIXEL_FORMATS:
             raise ValueError("color depth not supported")
+        self.protocol = RFBToGUI
+        self.depth = depth  # 32 for RGBX, 16 for RGB565 and 8 for BGR233 pixels
 
         if fast:
-            self.encodings = [
+            self.rectangle_encodings = [
                 COPY_RECTANGLE_ENCODING,
                 RAW_ENCODING,
             ]
         else:
-            self.encodings = [
+            self.rectangle_encodings = [
                 COPY_RECTANGLE_ENCODING,
+                TIGHT_ENCODING,
+                ZRLE_ENCODING,
+                ZLIBHEX_ENCODING,
+                ZLIB_ENCODING,
                 HEXTILE_ENCODING,
                 CORRE_ENCODING,
                 RRE_ENCODING,
                 RAW_ENCODING,
             ]
 
+        self.encodings = list(self.rectangle_encodings)
+        self.set_quality(jpeg_quality, compress_level)
+
+    def set_quality(self, jpeg_quality=None, compress_level=None):
+        """Select the tight JPEG quality and the zlib compression level (0-9 each).
+           JPEG is only offered when pygame can load JPEG images, None leaves the choice to the server."""
+        for level in (jpeg_quality, compress_level):
+            if level is not None and not 0 <= level <= 9:
+                raise ValueError("quality and compression levels must be between 0 and 9")
+
+        self.encodings = list(self.rectangle_encodings)
+        if jpeg_quality is not None and pygame.image.get_extended():
+            self.encodings.append(QUALITY_LEVEL_0_ENCODING + jpeg_quality)
+        if compress_level is not None:
+            self.encodings.append(COMPRESS_LEVEL_0_ENCODING + compress_level)
+        if self.continuous_updates:
+            self.encodings += [CONTINUOUS_UPDATES_ENCODING, FENCE_ENCODING]
+
     def buildProtocol(self, addr):
         pygame.display.set_caption('pyVNC on %s:%s' % (addr.host, addr.port))
         return RFBFactory.buildProtocol(self, addr)
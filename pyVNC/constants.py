@@ -81,4 +81,31 @@ MODIFIERS = {
     K_MENU: rfb.KEY_Hyper_L,  # ???
     # ~ K_POWER:            rfb.
     # ~ K_EURO:             rfb.
-}
\ No newline at end of file
+}
+
+def keysym(key):
+    """keysym of a modifier, a mapped key or a single character"""
+    if key in MODIFIERS:
+        return MODIFIERS[key]
+    elif key in KEYMAPPINGS:
+        return KEYMAPPINGS[key]
+    elif type(key) == str:
+        return ord(key)
+    raise ValueError("unknown key %r" % (key,))
+
+
+def text_keysyms(text):
+    """keysyms that type text, control characters go through KEYMAPPINGS (tab, return, backspace, escape)
+       and characters above Latin-1 use the Unicode keysyms"""
+    keys = []
+    for char in text:
+        code = ord(char)
+        if char == "\n":
+            keys.append(rfb.KEY_Return)
+        elif code in KEYMAPPINGS:
+            keys.append(KEYMAPPINGS[code])
+        elif code <= 0xff:
+            keys.append(code)
+        else:
+            keys.append(0x01000000 | code)
+    return keys
@@ -8,7 +8,7 @@ if __name__ == '__main__':
     parser.add_argument("--host", default="127.0.0.1", type=str, help="Hostname of the VNC Server")
     parser.add_argument("--port", default="5902", type=int, help="VNC Server Port")
     parser.add_argument("--password", default=None, type=str, help="Password of the VNC Server")
-    parser.add_argument("--depth", default=32, type=int, help="Color Depth")
+    parser.add_argument("--depth", default=32, type=int, help="Color Depth: 32, 16 (RGB565) or 8 (BGR233)")
     parser.add_argument("--fast", default=False, type=bool,  help="Fast encoding")
     parser.add_argument("--shared", default=False, type=bool,  help="Shared VNC Instance")
     args = parser.parse_args()
@@ -12,16 +12,23 @@ http://www.realvnc.com/docs/rfbproto.pdf
 MIT License
 """
 
+import io
+import threading
+import zlib
 from struct import pack, unpack
 
+import numpy as np
+import pygame
 from twisted.protocols.policies import TimeoutMixin
 from twisted.python import log
 from twisted.internet.protocol import Protocol
-from twisted.internet import protocol
+from twisted.internet import protocol, reactor
+from twisted.python import threadable
 
 # encoding-type
 # for SetEncodings()
 from pyVNC import pyDes
+from pyVNC.Metrics import Metrics
 
 RAW_ENCODING = 0
 COPY_RECTANGLE_ENCODING = 1
@@ -33,6 +40,22 @@ TIGHT_ENCODING = 7
 ZLIBHEX_ENCODING = 8
 ZRLE_ENCODING = 16
 # 0xffffff00 to 0xffffffff tight options
+COMPRESS_LEVEL_0_ENCODING = 0xffffff00  # up to COMPRESS_LEVEL_9 (0xffffff09)
+QUALITY_LEVEL_0_ENCODING = 0xffffffe0  # up to QUALITY_LEVEL_9 (0xffffffe9), enables JPEG
+# server pushes updates without requests once enabled, acknowledged with an EndOfContinuousUpdates message
+CONTINUOUS_UPDATES_ENCODING = 0xfffffec7  # -313
+FENCE_ENCODING = 0xfffffec8  # -312
+
+# Fence flags, a fence with FENCE_REQUEST set is answered with the flags the client understands
+FENCE_BLOCK_BEFORE = 1
+FENCE_BLOCK_AFTER = 2
+FENCE_SYNC_NEXT = 4
+FENCE_REQUEST = 1 << 31
+
+# names of the rectangle encodings, used in the metrics
+ENCODING_NAMES = {RAW_ENCODING: "raw", COPY_RECTANGLE_ENCODING: "copyrect", RRE_ENCODING: "rre",
+                  CORRE_ENCODING: "corre", HEXTILE_ENCODING: "hextile", ZLIB_ENCODING: "zlib",
+                  TIGHT_ENCODING: "tight", ZLIBHEX_ENCODING: "zlibhex", ZRLE_ENCODING: "zrle"}
 
 # keycode's
 # for KeyEvent()
@@ -102,12 +125,37 @@ KEY_KP_9 = 0xFFB9
 KEY_KP_Enter = 0xFF8D
 
 
+# KeyEvent message: type 4, down flag, padding, keysym
+KEY_EVENT_DTYPE = np.dtype([("type", "u1"), ("down", "u1"), ("padding", "u2"), ("key", ">u4")])
+
+# initial size of the receive buffer, it grows to fit the largest expected block. a drained buffer
+# larger than RECEIVE_BUFFER_LIMIT is replaced by a new one, large rectangles do not keep their memory
+RECEIVE_BUFFER_SIZE = 1 << 16
+RECEIVE_BUFFER_LIMIT = 1 << 18
+
+
 class RFBClient(Protocol, TimeoutMixin):
     def __init__(self):
-        self._packet = []
-        self._packet_len = 0
+        self._buffer = bytearray(RECEIVE_BUFFER_SIZE)  # received data is buffer[offset:end]
+        self._buffer_offset = 0
+        self._buffer_end = 0
         self._handler = self._handle_initial
         self._already_expecting = 0
+        self._zrle_stream = zlib.decompressobj()  # one zlib stream for the whole connection
+        self._zlib_stream = zlib.decompressobj()
+        self._zlibhex_raw_stream = zlib.decompressobj()
+        self._zlibhex_stream = zlib.decompressobj()
+        self._tight_streams = [zlib.decompressobj() for _ in range(4)]
+        self.capture = None  # receives the server -> client bytes from the ServerInit message on
+        self.metrics = None  # Metrics of the connection when the factory enables them
+        self._outgoing = []  # client -> server messages waiting for the next flush
+        self._outgoing_lock = threading.Lock()
+        self._flush_scheduled = False
+        self.continuous_updates = False  # the server pushes updates, incremental requests are not needed
+
+    def connectionMade(self):
+        if self.factory.metrics:
+            self.metrics = Metrics()
 
     def timeoutConnection(self):
         self.transport.abortConnection()
@@ -118,25 +166,22 @@ class RFBClient(Protocol, TimeoutMixin):
     # ------------------------------------------------------
 
     def _handle_initial(self):
-        buffer = b''.join(self._packet)
+        buffer = bytes(self._buffer[self._buffer_offset:self._buffer_end])
         if b'\n' in buffer:
-            if buffer[:3] == 'RFB':
+            if buffer[:3] == b'RFB':
                 # ~ print "rfb"
-                maj, min = [int(x) for x in buffer[3:-1].split(b'.')]
+                maj, min = [int(x) for x in buffer[3:buffer.index(b'\n')].split(b'.')]
                 # ~ print maj, min
-                if (maj, min) not in [(3, 3), (3, 7), (3, 8)]:
+                # any 3.x (e.g. 3.889 of macOS) or later server speaks 3.3 when the client replies 3.3
+                if maj < 3:
                     log.msg("wrong protocol version\n")
                     self.transport.loseConnection()
-            buffer = buffer[12:]
+                    return
+            self._buffer_offset += 12
             self.transport.write(b'RFB 003.003\n')
             log.msg("connected\n")
-            self._packet[:] = [buffer]
-            self._packet_len = len(buffer)
             self._handler = self._handle_expected
             self.expect(self._handle_auth, 4)
-        else:
-            self._packet[:] = [buffer]
-            self._packet_len = len(buffer)
 
     def _handle_auth(self, block):
         (auth,) = unpack("!I", block)
@@ -156,10 +201,10 @@ class RFBClient(Protocol, TimeoutMixin):
         self.expect(self._handle_connection_message, waitfor)
 
     def _handle_connection_message(self, block):
-        log.msg("Connection refused: %r\n" % block)
+        log.msg("Connection refused: %r\n" % bytes(block))
 
     def _handle_vnc_auth(self, block):
-        self._challenge = block
+        self._challenge = bytes(block)
         self.vnc_request_password()
         self.expect(self._handle_vnc_auth_result, 4)
 
@@ -187,6 +232,10 @@ class RFBClient(Protocol, TimeoutMixin):
 
     def _do_client_initialization(self):
         self.transport.write(pack("!B", self.factory.shared))
+        if self.factory.capture is not None:
+            # the ServerInit message may already be buffered
+            self.capture = self.factory.capture
+            self.capture.write(self._buffer[self._buffer_offset:self._buffer_end])
         self.expect(self._handle_server_init, 24)
 
     def _handle_server_init(self, block):
@@ -195,11 +244,11 @@ class RFBClient(Protocol, TimeoutMixin):
          self.redmax, self.greenmax, self.bluemax,
          self.redshift, self.greenshift, self.blueshift) = \
             unpack("!BBBBHHHBBBxxx", pixformat)
-        self.bypp = self.bpp / 8  # calc bytes per pixel
+        self.bypp = self.bpp // 8  # calc bytes per pixel
         self.expect(self._handle_server_name, namelen)
 
     def _handle_server_name(self, block):
-        self.name = block
+        self.name = bytes(block)
         # callback:
         self.vnc_connection_made()
         self.expect(self._handle_connection, 1)
@@ -211,11 +260,18 @@ class RFBClient(Protocol, TimeoutMixin):
         (msgid,) = unpack("!B", block)
         if msgid == 0:
             self.expect(self._handle_framebuffer_update, 3)
+        elif msgid == 1:
+            self.expect(self._handle_set_colour_map_entries, 5)
         elif msgid == 2:
             self.bell()
             self.expect(self._handle_connection, 1)
         elif msgid == 3:
             self.expect(self._handle_server_cut_text, 7)
+        elif msgid == 150:
+            self.end_of_continuous_updates()
+            self.expect(self._handle_connection, 1)
+        elif msgid == 248:
+            self.expect(self._handle_fence, 8)
         else:
             log.msg("unknown message received (id %d)\n" % msgid)
             self.expect(self._handle_connection, 1)
@@ -223,13 +279,19 @@ class RFBClient(Protocol, TimeoutMixin):
     def _handle_framebuffer_update(self, block):
         (self.rectangles,) = unpack("!xH", block)
         self.rectanglePos = []
+        if self.metrics is not None:
+            self.metrics.update_started()
         self.begin_update()
         self._do_connection()
 
     def _do_connection(self):
+        if self.metrics is not None:
+            self.metrics.switch(None)
         if self.rectangles:
             self.expect(self._handle_rectangle, 12)
         else:
+            if self.metrics is not None:
+                self.metrics.update_complete(len(self.rectanglePos))
             self.commit_update(self.rectanglePos)
             self.expect(self._handle_connection, 1)
 
@@ -238,18 +300,24 @@ class RFBClient(Protocol, TimeoutMixin):
         if self.rectangles:
             self.rectangles -= 1
             self.rectanglePos.append((x, y, width, height))
+            if self.metrics is not None:
+                self.metrics.rectangle(encoding)
             if encoding == COPY_RECTANGLE_ENCODING:
                 self.expect(self._handleDecodeCopyrect, 4, x, y, width, height)
             elif encoding == RAW_ENCODING:
                 self.expect(self._handle_decode_raw, width * height * self.bypp, x, y, width, height)
-            elif encoding == HEXTILE_ENCODING:
+            elif encoding in (HEXTILE_ENCODING, ZLIBHEX_ENCODING):
                 self._do_next_hextile_subrect(None, None, x, y, width, height, None, None)
+            elif encoding == ZLIB_ENCODING:
+                self.expect(self._handle_decode_zlib, 4, x, y, width, height)
             elif encoding == CORRE_ENCODING:
                 self.expect(self._handle_decode_corre, 4 + self.bypp, x, y, width, height)
             elif encoding == RRE_ENCODING:
                 self.expect(self._handleDecodeRRE, 4 + self.bypp, x, y, width, height)
-                # ~ elif encoding == ZRLE_ENCODING:
-                # ~ self.expect(self._handleDecodeZRLE, )
+            elif encoding == ZRLE_ENCODING:
+                self.expect(self._handle_decode_zrle, 4, x, y, width, height)
+            elif encoding == TIGHT_ENCODING:
+                self.expect(self._handle_decode_tight, 1, x, y, width, height)
             else:
                 log.msg("unknown encoding received (encoding %d)\n" % encoding)
                 self._do_connection()
@@ -289,15 +357,7 @@ class RFBClient(Protocol, TimeoutMixin):
         :param topy:
         :return:
         """
-
-        pos = 0
-        end = len(block)
-        sz = self.bypp + 8
-        format = "!%dsHHHH" % self.bypp
-        while pos < end:
-            (color, x, y, width, height) = unpack(format, block[pos:pos + sz])
-            self.fill_rectangle(topx + x, topy + y, width, height, color)
-            pos += sz
+        self._fill_sub_rectangles(block, topx, topy, ">u2")
         self._do_connection()
 
     def _handle_decode_corre(self, block, x, y, width, height):
@@ -320,16 +380,18 @@ class RFBClient(Protocol, TimeoutMixin):
 
     def _handle_decode_corre_rectangles(self, block, topx, topy):
         # ~ print "_handleDecodeCORRERectangle"
-        pos = 0
-        end = len(block)
-        sz = self.bypp + 4
-        format = "!%dsBBBB" % self.bypp
-        while pos < sz:
-            (color, x, y, width, height) = unpack(format, block[pos:pos + sz])
-            self.fill_rectangle(topx + x, topy + y, width, height, color)
-            pos += sz
+        self._fill_sub_rectangles(block, topx, topy, "u1")
         self._do_connection()
 
+    def _fill_sub_rectangles(self, block, topx, topy, coordinate):
+        """paint all (pixel, x, y, width, height) RRE / CoRRE subrects of block at once"""
+        subrects = np.frombuffer(block, np.dtype([("color", np.uint8, (self.bypp,)),
+                                                  ("x", coordinate), ("y", coordinate),
+                                                  ("width", coordinate), ("height", coordinate)]))
+        rectangles = np.column_stack((subrects["x"].astype(np.intp) + topx, subrects["y"].astype(np.intp) + topy,
+                                      subrects["width"], subrects["height"]))
+        self.fill_rectangles(rectangles, subrects["color"])
+
     def _do_next_hextile_subrect(self, bg, color, x, y, width, height, tx, ty):
         """
         # Hextile Encoding
@@ -358,12 +420,124 @@ class RFBClient(Protocol, TimeoutMixin):
         else:
             tx = x
             ty = y
+        # decode what is already received in one go
+        if ty < y + height and self._buffer_offset < self._buffer_end:
+            bg, color, tx, ty = self._decode_hextile_buffered(bg, color, x, y, width, height, tx, ty)
         # more tiles?
         if ty >= y + height:
             self._do_connection()
         else:
             self.expect(self._handle_decode_hextile, 1, bg, color, x, y, width, height, tx, ty)
 
+    def _decode_hextile_buffered(self, bg, color, x, y, width, height, tx, ty):
+        """
+        # Hextile Decoding of buffered tiles
+        parses all tiles that are completely in the receive buffer in a single pass.
+        raw tiles are painted right away, the backgrounds of a row of tiles with one
+        update and the subrects of all tiles in one batch. the tile state machine
+        takes over at the first incomplete tile.
+        :return: bg, color, tx, ty of the next tile
+        """
+        data = memoryview(self._buffer)[self._buffer_offset:self._buffer_end]
+        bypp = self.bypp
+        end = len(data)
+        pos = 0
+        rows = []  # (tx, ty, th, background of every tile or None if already painted)
+        row = []
+        row_x = tx
+        subrect_tiles = {2: [], bypp + 2: []}  # subrect size -> (offset, count, tx, ty) per tile
+        foregrounds = []
+        while ty < y + height and pos < end:
+            tw = min(16, x + width - tx)
+            th = min(16, y + height - ty)
+            subencoding = data[pos]
+            start = pos + 1
+            if subencoding & 96:  # ZlibRaw or Zlib (ZlibHex only)
+                stop = start + 2
+                if stop > end or stop + (data[start] << 8 | data[start + 1]) > end:
+                    break
+                stop += data[start] << 8 | data[start + 1]
+                if subencoding & 32:
+                    self.update_rectangle(tx, ty, tw, th, self._zlibhex_raw_stream.decompress(data[start + 2:stop]))
+                else:
+                    tile = self._zlibhex_stream.decompress(data[start + 2:stop])
+                    bg, color = self._decode_hextile_tile(tile, subencoding, bg, color, tx, ty, tw, th)
+                row.append(None)
+            elif subencoding & 1:  # RAW
+                stop = start + tw * th * bypp
+                if stop > end:
+                    break
+                self.update_rectangle(tx, ty, tw, th, data[start:stop])
+                row.append(None)
+            else:
+                stop = start + bypp * (subencoding >> 1 & 1) + bypp * (subencoding >> 2 & 1) + (subencoding >> 3 & 1)
+                if stop > end:
+                    break
+                subrects = data[stop - 1] if subencoding & 8 else 0  # AnySubrects
+                size = bypp + 2 if subencoding & 16 else 2  # SubrectsColoured
+                if stop + subrects * size > end:
+                    break
+                if subencoding & 2:  # BackgroundSpecified
+                    bg = bytes(data[start:start + bypp])
+                    start += bypp
+                if subencoding & 4:  # ForegroundSpecified
+                    color = bytes(data[start:start + bypp])
+                row.append(bg)
+                if subrects:
+                    subrect_tiles[size].append((stop, subrects, tx, ty))
+                    if size == 2:
+                        foregrounds.append(color)
+                    else:
+                        last = stop + (subrects - 1) * size
+                        color = bytes(data[last:last + bypp])
+                stop += subrects * size
+            pos = stop
+            tx += 16
+            if tx >= x + width:
+                rows.append((row_x, ty, th, row))
+                row = []
+                tx = row_x = x
+                ty += 16
+        if row:
+            rows.append((row_x, ty, th, row))
+        self._buffer_offset += pos
+
+        for row_x, row_y, row_height, row in rows:
+            self._fill_hextile_backgrounds(row_x, row_y, row_height, row, x + width)
+        rectangles, colors = [], []
+        raw = np.frombuffer(data[:pos], np.uint8)
+        for size, tiles in subrect_tiles.items():
+            if not tiles:
+                continue
+            offsets, counts, txs, tys = np.array(tiles).T
+            subrects = concat_ranges(offsets, counts, size)
+            if size == 2:
+                colors.append(np.repeat(np.frombuffer(b''.join(foregrounds), np.uint8).reshape(-1, bypp), counts, axis=0))
+            else:
+                colors.append(raw[np.add.outer(subrects, np.arange(bypp))])
+                subrects += bypp
+            xy = raw[subrects]
+            wh = raw[subrects + 1]
+            rectangles.append(np.column_stack((np.repeat(txs, counts) + (xy >> 4), np.repeat(tys, counts) + (xy & 0xf),
+                                               (wh >> 4) + 1, (wh & 0xf) + 1)))
+        if rectangles:
+            self.fill_rectangles(np.concatenate(rectangles), np.concatenate(colors))
+        return bg, color, tx, ty
+
+    def _fill_hextile_backgrounds(self, tx, ty, th, backgrounds, right):
+        """paint the backgrounds of a row of tiles, consecutive tiles with a single update"""
+        start = 0
+        for i in range(len(backgrounds) + 1):
+            if i < len(backgrounds) and backgrounds[i] is not None:
+                continue
+            if i > start:
+                sx = tx + 16 * start
+                sw = min(tx + 16 * i, right) - sx
+                colors = np.frombuffer(b''.join(backgrounds[start:i]), np.uint8).reshape(-1, self.bypp)
+                strip = np.repeat(colors, 16, axis=0)[:sw]
+                self.update_rectangle(sx, ty, sw, th, np.ascontiguousarray(np.broadcast_to(strip, (th, sw, self.bypp))))
+            start = i + 1
+
     def _handle_decode_hextile(self, block, bg, color, x, y, width, height, tx, ty):
         """
         # Hextile Decoding
@@ -388,7 +562,13 @@ class RFBClient(Protocol, TimeoutMixin):
             th = y + height - ty
 
         # decode tile
-        if sub_encoding & 1:  # RAW
+        if sub_encoding & 32:  # ZlibRaw (ZlibHex only)
+            self.expect(self._handle_decode_zlibhex_length, 2, self._handle_decode_zlibhex_raw, bg, color,
+                        x, y, width, height, tx, ty, tw, th)
+        elif sub_encoding & 64:  # Zlib (ZlibHex only)
+            self.expect(self._handle_decode_zlibhex_length, 2, self._handle_decode_zlibhex_tile, sub_encoding, bg, color,
+                        x, y, width, height, tx, ty, tw, th)
+        elif sub_encoding & 1:  # RAW
             self.expect(self._handle_decode_hextile_raw, tw * th * self.bypp, bg, color, x, y, width, height, tx, ty, tw,
                         th)
         else:
@@ -410,11 +590,11 @@ class RFBClient(Protocol, TimeoutMixin):
         subrects = 0
         pos = 0
         if subencoding & 2:  # BackgroundSpecified
-            bg = block[:int(self.bypp)]
+            bg = bytes(block[:self.bypp])
             pos += self.bypp
         self.fill_rectangle(tx, ty, tw, th, bg)
         if subencoding & 4:  # ForegroundSpecified
-            color = block[pos:pos + self.bypp]
+            color = bytes(block[pos:pos + self.bypp])
             pos += self.bypp
         if subencoding & 8:  # AnySubrects
             # ~ (subrects, ) = unpack("!B", block)
@@ -437,6 +617,17 @@ class RFBClient(Protocol, TimeoutMixin):
 
     def _handle_decode_hextile_subrects_coloured(self, block, bg, color, subrects, x, y, width, height, tx, ty, tw, th):
         """subrects with their own color"""
+        color = self._fill_hextile_subrects_coloured(block, tx, ty)
+        self._do_next_hextile_subrect(bg, color, x, y, width, height, tx, ty)
+
+    def _handle_decode_hextile_subrects_fg(self, block, bg, color, subrects, x, y, width, height, tx, ty, tw, th):
+        """all subrect with same color"""
+        self._fill_hextile_subrects_fg(block, color, tx, ty)
+        self._do_next_hextile_subrect(bg, color, x, y, width, height, tx, ty)
+
+    def _fill_hextile_subrects_coloured(self, block, tx, ty):
+        """paint subrects that carry their own color, returns the last color"""
+        color = None
         sz = self.bypp + 2
         pos = 0
         end = len(block)
@@ -451,10 +642,10 @@ class RFBClient(Protocol, TimeoutMixin):
             sh = (wh & 0xf) + 1
             self.fill_rectangle(tx + sx, ty + sy, sw, sh, color)
             pos += sz
-        self._do_next_hextile_subrect(bg, color, x, y, width, height, tx, ty)
+        return bytes(color)
 
-    def _handle_decode_hextile_subrects_fg(self, block, bg, color, subrects, x, y, width, height, tx, ty, tw, th):
-        """all subrect with same color"""
+    def _fill_hextile_subrects_fg(self, block, color, tx, ty):
+        """paint subrects in the foreground color"""
         pos = 0
         end = len(block)
         while pos < end:
@@ -466,21 +657,337 @@ class RFBClient(Protocol, TimeoutMixin):
             sh = (wh & 0xf) + 1
             self.fill_rectangle(tx + sx, ty + sy, sw, sh, color)
             pos += 2
+
+    def _decode_hextile_tile(self, data, subencoding, bg, color, tx, ty, tw, th):
+        """decode a complete hextile tile body (everything after the subencoding byte),
+           returns the background and foreground colors for the next tile"""
+        if subencoding & 1:  # RAW
+            self.update_rectangle(tx, ty, tw, th, data[:tw * th * self.bypp])
+            return bg, color
+        pos = 0
+        if subencoding & 2:  # BackgroundSpecified
+            bg = data[:self.bypp]
+            pos += self.bypp
+        self.fill_rectangle(tx, ty, tw, th, bg)
+        if subencoding & 4:  # ForegroundSpecified
+            color = data[pos:pos + self.bypp]
+            pos += self.bypp
+        if subencoding & 8 and data[pos]:  # AnySubrects
+            subrects = data[pos]
+            pos += 1
+            if subencoding & 16:  # SubrectsColoured
+                color = self._fill_hextile_subrects_coloured(data[pos:pos + (self.bypp + 2) * subrects], tx, ty)
+            else:
+                self._fill_hextile_subrects_fg(data[pos:pos + 2 * subrects], color, tx, ty)
+        return bg, color
+
+    # ---  ZlibHex Encoding
+
+    def _handle_decode_zlibhex_length(self, block, handler, *args):
+        (length,) = unpack("!H", block)
+        self.expect(handler, length, *args)
+
+    def _handle_decode_zlibhex_raw(self, block, bg, color, x, y, width, height, tx, ty, tw, th):
+        """the tile is in raw encoding, compressed with the raw stream"""
+        self.update_rectangle(tx, ty, tw, th, self._zlibhex_raw_stream.decompress(block))
         self._do_next_hextile_subrect(bg, color, x, y, width, height, tx, ty)
 
+    def _handle_decode_zlibhex_tile(self, block, subencoding, bg, color, x, y, width, height, tx, ty, tw, th):
+        """the hextile tile data is compressed with the encoded stream"""
+        data = self._zlibhex_stream.decompress(block)
+        bg, color = self._decode_hextile_tile(data, subencoding, bg, color, tx, ty, tw, th)
+        self._do_next_hextile_subrect(bg, color, x, y, width, height, tx, ty)
+
+    # ---  Zlib Encoding
+
+    def _handle_decode_zlib(self, block, x, y, width, height):
+        (length,) = unpack("!I", block)
+        self.expect(self._handle_decode_zlib_data, length, x, y, width, height)
+
+    def _handle_decode_zlib_data(self, block, x, y, width, height):
+        """raw pixel data, compressed with the zlib stream of the connection"""
+        self.update_rectangle(x, y, width, height, self._zlib_stream.decompress(block))
+        self._do_connection()
+
     # ---  ZRLE Encoding
 
-    def _handle_decode_zrle(self, block):
-        raise NotImplementedError
+    def _handle_decode_zrle(self, block, x, y, width, height):
+        (length,) = unpack("!I", block)
+        self.expect(self._handle_decode_zrle_data, length, x, y, width, height)
+
+    def _handle_decode_zrle_data(self, block, x, y, width, height):
+        """
+        # ZRLE Tiles
+        the rectangle is split in 64x64 tiles, left to right and top to bottom
+        :param block: zlib compressed tile data
+        :param x:
+        :param y:
+        :param width:
+        :param height:
+        :return:
+        """
+        data = self._zrle_stream.decompress(block)
+        pos = 0
+        for ty in range(y, y + height, 64):
+            th = min(64, y + height - ty)
+            for tx in range(x, x + width, 64):
+                tw = min(64, x + width - tx)
+                pos = self._decode_zrle_tile(data, pos, tx, ty, tw, th)
+        self._do_connection()
+
+    def _decode_zrle_tile(self, data, pos, tx, ty, tw, th):
+        """decode one ZRLE tile starting at data[pos], returns the position after it"""
+        sub_encoding = data[pos]
+        pos += 1
+        size = self._cpixel_size()
+        if sub_encoding == 0:  # Raw
+            end = pos + tw * th * size
+            self.update_rectangle(tx, ty, tw, th, self._cpixels(data[pos:end]))
+        elif sub_encoding == 1:  # Solid
+            end = pos + size
+            self.fill_rectangle(tx, ty, tw, th, self._cpixels(data[pos:end]).tobytes())
+        elif sub_encoding <= 16:  # Packed Palette
+            end = pos + sub_encoding * size
+            palette = self._cpixels(data[pos:end])
+            bits = 1 if sub_encoding == 2 else 2 if sub_encoding <= 4 else 4
+            pos, end = end, end + (tw * bits + 7) // 8 * th
+            indices = unpack_bits(np.frombuffer(data, np.uint8, end - pos, pos).reshape(th, -1), bits)
+            self.update_rectangle(tx, ty, tw, th, palette[indices[:, :tw]])
+        elif sub_encoding == 128:  # Plain RLE
+            offsets, lengths = [], []
+            count = tw * th
+            end = pos
+            while count > 0:
+                offsets.append(end)
+                end += size
+                length = 1
+                while data[end] == 255:
+                    length += 255
+                    end += 1
+                length += data[end]
+                end += 1
+                lengths.append(length)
+                count -= length
+            raw = np.frombuffer(data, np.uint8)
+            colors = self._cpixels(raw[np.add.outer(offsets, np.arange(size))])
+            self.update_rectangle(tx, ty, tw, th, np.repeat(colors, lengths, axis=0)[:tw * th])
+        elif sub_encoding >= 130:  # Palette RLE
+            end = pos + (sub_encoding - 128) * size
+            palette = self._cpixels(data[pos:end])
+            indices, lengths = [], []
+            count = tw * th
+            while count > 0:
+                index = data[end]
+                end += 1
+                length = 1
+                if index & 128:
+                    while data[end] == 255:
+                        length += 255
+                        end += 1
+                    length += data[end]
+                    end += 1
+                indices.append(index & 127)
+                lengths.append(length)
+                count -= length
+            self.update_rectangle(tx, ty, tw, th, np.repeat(palette[indices], lengths, axis=0)[:tw * th])
+        else:
+            raise ValueError("invalid ZRLE sub encoding (%d)" % sub_encoding)
+        return end
+
+    # ---  Tight Encoding
+
+    def _handle_decode_tight(self, block, x, y, width, height):
+        """
+        # Tight Compression Control
+        :param block: compression control byte
+        :param x:
+        :param y:
+        :param width:
+        :param height:
+        :return:
+        """
+        (control,) = unpack("!B", block)
+        for stream in range(4):
+            if control & (1 << stream):  # reset zlib stream
+                self._tight_streams[stream] = zlib.decompressobj()
+        control >>= 4
+        if control == 8:  # FillCompression
+            self.expect(self._handle_decode_tight_fill, self._tpixel_size(), x, y, width, height)
+        elif control == 9:  # JpegCompression
+            self._expect_compact_length(self._handle_decode_tight_jpeg, x, y, width, height)
+        elif control & 8:
+            log.msg("unknown tight compression received (%d)\n" % control)
+            self.transport.loseConnection()
+        elif control & 4:  # ReadFilterId
+            self.expect(self._handle_decode_tight_filter, 1, control & 3, x, y, width, height)
+        else:
+            self._do_tight_basic(control & 3, 0, None, x, y, width, height)
+
+    def _handle_decode_tight_fill(self, block, x, y, width, height):
+        self.fill_rectangle(x, y, width, height, self._tpixels(block).tobytes())
+        self._do_connection()
+
+    def _handle_decode_tight_jpeg(self, block, x, y, width, height):
+        image = pygame.image.load(io.BytesIO(block), "rect.jpg")
+        rgb = np.frombuffer(pygame.image.tostring(image, 'RGB'), np.uint8).reshape(height, width, 3)
+        self.update_rectangle(x, y, width, height, self._pack_rgb(rgb))
+        self._do_connection()
+
+    def _handle_decode_tight_filter(self, block, stream, x, y, width, height):
+        (tight_filter,) = unpack("!B", block)
+        if tight_filter == 1:  # PaletteFilter
+            self.expect(self._handle_decode_tight_palette_size, 1, stream, x, y, width, height)
+        elif tight_filter in (0, 2):  # CopyFilter, GradientFilter
+            self._do_tight_basic(stream, tight_filter, None, x, y, width, height)
+        else:
+            log.msg("unknown tight filter received (%d)\n" % tight_filter)
+            self.transport.loseConnection()
+
+    def _handle_decode_tight_palette_size(self, block, stream, x, y, width, height):
+        colors = block[0] + 1
+        self.expect(self._handle_decode_tight_palette, colors * self._tpixel_size(), stream, x, y, width, height)
+
+    def _handle_decode_tight_palette(self, block, stream, x, y, width, height):
+        self._do_tight_basic(stream, 1, self._tpixels(block).copy(), x, y, width, height)
+
+    def _do_tight_basic(self, stream, tight_filter, palette, x, y, width, height):
+        if tight_filter != 1:
+            size = width * height * self._tpixel_size()
+        elif len(palette) == 2:
+            size = (width + 7) // 8 * height
+        else:
+            size = width * height
+        if size < 12:  # sent uncompressed
+            self.expect(self._handle_decode_tight_data, size, None, tight_filter, palette, x, y, width, height)
+        else:
+            self._expect_compact_length(self._handle_decode_tight_data, stream, tight_filter, palette,
+                                        x, y, width, height)
+
+    def _handle_decode_tight_data(self, block, stream, tight_filter, palette, x, y, width, height):
+        data = block if stream is None else self._tight_streams[stream].decompress(block)
+        if tight_filter == 0:  # CopyFilter
+            pixels = self._tpixels(data)
+        elif tight_filter == 1:  # PaletteFilter
+            if len(palette) == 2:
+                indices = unpack_bits(np.frombuffer(data, np.uint8).reshape(height, -1), 1)[:, :width]
+            else:
+                indices = np.frombuffer(data, np.uint8).reshape(height, width)
+            pixels = palette[indices]
+        elif self._tpixel_size() == 3:  # GradientFilter on red, green, blue bytes
+            diff = np.frombuffer(data, np.uint8).reshape(height, width, 3)
+            pixels = self._pack_rgb(gradient_decode(diff, np.array([255, 255, 255])))
+        else:  # GradientFilter on the components of the pixel format
+            values = self._pixel_values(data).reshape(height, width)
+            shifts = np.array([self.redshift, self.greenshift, self.blueshift])
+            maxes = np.array([self.redmax, self.greenmax, self.bluemax])
+            components = gradient_decode((values[..., None] >> shifts) & maxes, maxes)
+            pixels = self._pack_pixel_values(np.bitwise_or.reduce(components << shifts, axis=2))
+        self.update_rectangle(x, y, width, height, pixels)
+        self._do_connection()
+
+    def _expect_compact_length(self, handler, *args):
+        """read a tight compact length (1 to 3 bytes) and then expect that many bytes for handler"""
+        self.expect(self._handle_compact_length, 1, 0, 0, handler, args)
+
+    def _handle_compact_length(self, block, length, shift, handler, args):
+        value = block[0]
+        if shift == 14:  # the third byte uses all 8 bits
+            length |= value << shift
+        else:
+            length |= (value & 0x7f) << shift
+            if value & 0x80:
+                self.expect(self._handle_compact_length, 1, length, shift + 7, handler, args)
+                return
+        self.expect(handler, length, *args)
+
+    def _tpixel_size(self):
+        """bytes per tight pixel (TPIXEL), 3 for red, green, blue when the format is 24 bit true colour"""
+        if (self.bpp == 32 and self.depth == 24 and self.truecolor and
+                self.redmax == self.greenmax == self.bluemax == 255):
+            return 3
+        return self.bypp
+
+    def _tpixels(self, data):
+        """expand TPIXEL data to an array of pixels, one row of bypp bytes per pixel"""
+        if self._tpixel_size() == 3:
+            return self._pack_rgb(np.frombuffer(data, np.uint8).reshape(-1, 3))
+        return np.frombuffer(data, np.uint8).reshape(-1, self.bypp)
+
+    # ---  pixel helpers
+
+    def _pixel_values(self, data):
+        """interpret pixel data as an array of integer pixel values"""
+        dtype = ('>u%d' if self.bigendian else '<u%d') % self.bypp
+        return np.frombuffer(data, dtype).astype(np.uint32)
+
+    def _pack_pixel_values(self, values):
+        """convert an array of integer pixel values to pixel data, one row of bypp bytes per pixel"""
+        dtype = ('>u%d' if self.bigendian else '<u%d') % self.bypp
+        return values.astype(dtype).view(np.uint8).reshape(values.shape + (self.bypp,))
+
+    def _pack_rgb(self, rgb):
+        """convert an array of 8 bit red, green, blue triples to pixels in the current pixel format"""
+        rgb = rgb.astype(np.uint32)
+        maxes = np.array([self.redmax, self.greenmax, self.bluemax], np.uint32)
+        if (maxes != 255).any():
+            rgb = (rgb * maxes + 127) // 255
+        values = rgb[..., 0] << self.redshift | rgb[..., 1] << self.greenshift | rgb[..., 2] << self.blueshift
+        return self._pack_pixel_values(values)
+
+    def _cpixel_size(self):
+        """bytes per compressed pixel (CPIXEL) in the current pixel format"""
+        return 3 if self._cpixel_pad() is not None else self.bypp
+
+    def _cpixel_pad(self):
+        """the byte of a 32 bit pixel that is left out of a CPIXEL, None if CPIXEL == PIXEL"""
+        if self.bpp != 32 or self.depth > 24 or not self.truecolor:
+            return None
+        mask = self.redmax << self.redshift | self.greenmax << self.greenshift | self.bluemax << self.blueshift
+        if mask < 1 << 24:  # fits in the least significant bytes
+            return 0 if self.bigendian else 3
+        if not mask & 0xff:  # fits in the most significant bytes
+            return 3 if self.bigendian else 0
+        return None
+
+    def _cpixels(self, data):
+        """expand CPIXEL data to an array of pixels, one row of bypp bytes per pixel"""
+        pad = self._cpixel_pad()
+        if pad is None:
+            return np.frombuffer(data, np.uint8).reshape(-1, self.bypp)
+        cpixels = np.frombuffer(data, np.uint8).reshape(-1, 3)
+        pixels = np.zeros((len(cpixels), 4), np.uint8)
+        if pad:
+            pixels[:, :3] = cpixels
+        else:
+            pixels[:, 1:] = cpixels
+        return pixels
 
     # ---  other server messages
 
+    def _handle_set_colour_map_entries(self, block):
+        (first, count) = unpack("!xHH", block)
+        self.expect(self._handle_colour_map_entries, 6 * count, first)
+
+    def _handle_colour_map_entries(self, block, first):
+        self.set_colour_map_entries(first, np.frombuffer(block, ">u2").reshape(-1, 3))
+        self.expect(self._handle_connection, 1)
+
     def _handle_server_cut_text(self, block):
         (length,) = unpack("!xxxI", block)
         self.expect(self._handle_server_cut_text_value, length)
 
     def _handle_server_cut_text_value(self, block):
-        self.copy_text(block)
+        self.copy_text(bytes(block))
+        self.expect(self._handle_connection, 1)
+
+    # ---  Fence
+
+    def _handle_fence(self, block):
+        (flags, length) = unpack("!xxxIB", block)
+        self.expect(self._handle_fence_payload, length, flags)
+
+    def _handle_fence_payload(self, block, flags):
+        self.fence(flags, bytes(block))
         self.expect(self._handle_connection, 1)
 
     # ------------------------------------------------------
@@ -488,25 +995,75 @@ class RFBClient(Protocol, TimeoutMixin):
     # ------------------------------------------------------
     def dataReceived(self, data):
         # ~ sys.stdout.write(repr(data) + '\n')
-        # ~ print len(data), ", ", len(self._packet)
-        self._packet.append(data)
-        self._packet_len += len(data)
+        size = len(data)
+        self._reserve(size)
+        self._buffer[self._buffer_end:self._buffer_end + size] = data
+        if self.capture is not None:
+            self.capture.write(data)
+        if self.metrics is not None:
+            self.metrics.bytes_received += size
+        self._buffer_end += size
+        self._handler()
+
+    def get_receive_buffer(self, size):
+        """writable view of at least size free bytes after the buffered data,
+           for transports that read directly into the receive buffer"""
+        self._reserve(size)
+        return memoryview(self._buffer)[self._buffer_end:]
+
+    def receive_buffer_updated(self, size):
+        """size bytes were written to the view returned by get_receive_buffer"""
+        if self.capture is not None:
+            self.capture.write(self._buffer[self._buffer_end:self._buffer_end + size])
+        if self.metrics is not None:
+            self.metrics.bytes_received += size
+        self._buffer_end += size
         self._handler()
 
+    def memory(self):
+        """bytes the connection keeps besides the framebuffer"""
+        return {"receive": len(self._buffer)}
+
+    def _reserve(self, size):
+        """make room for size more bytes after the buffered data.
+           unread data is moved to the front or into a larger buffer, so
+           it is only copied again when the buffer runs full."""
+        if self._buffer_end + size <= len(self._buffer):
+            return
+        pending = self._buffer_end - self._buffer_offset
+        if pending + size <= len(self._buffer) // 2:
+            self._buffer[:pending] = self._buffer[self._buffer_offset:self._buffer_end]
+        else:
+            # a new buffer, blocks still referenced by handlers keep the old one alive
+            buffer = bytearray(max(2 * len(self._buffer), pending + size))
+            buffer[:pending] = self._buffer[self._buffer_offset:self._buffer_end]
+            self._buffer = buffer
+        self._buffer_offset = 0
+        self._buffer_end = pending
+
     def _handle_expected(self):
-        if self._packet_len >= self._expected_len:
-            buffer = b''.join(self._packet)
-            while len(buffer) >= self._expected_len:
-                self._already_expecting = 1
-
-                block, buffer = buffer[:self._expected_len], buffer[self._expected_len:]
-                # ~ log.msg("handle %r with %r\n" % (block, self._expected_handler.__name__))
-                self._expected_handler(block, *self._expected_args, **self._expected_kwargs)
-            self._packet[:] = [buffer]
-            self._packet_len = len(buffer)
-            self._already_expecting = 0
+        if self.metrics is not None:
+            self.metrics.resume()
+        view = memoryview(self._buffer)
+        while self._buffer_end - self._buffer_offset >= self._expected_len:
+            self._already_expecting = 1
+
+            start = self._buffer_offset
+            self._buffer_offset += self._expected_len
+            # ~ log.msg("handle %r with %r\n" % (block, self._expected_handler.__name__))
+            self._expected_handler(view[start:self._buffer_offset], *self._expected_args, **self._expected_kwargs)
+        if self._buffer_offset == self._buffer_end:
+            self._buffer_offset = self._buffer_end = 0
+            if len(self._buffer) > RECEIVE_BUFFER_LIMIT and self._expected_len <= RECEIVE_BUFFER_SIZE:
+                self._buffer = bytearray(RECEIVE_BUFFER_SIZE)
+        self._already_expecting = 0
+        if self.metrics is not None:
+            self.metrics.pause()
 
     def expect(self, handler, size, *args, **kwargs):
+        """call handler(block, *args, **kwargs) once size bytes are received.
+           block is a memoryview into the receive buffer that is only valid
+           during the call, handlers copy what they keep."""
         # ~ log.msg("expect(%r, %r, %r, %r)\n" % (handler.__name__, size, args, kwargs))
         self._expected_handler = handler
         self._expected_len = size
@@ -523,7 +1080,9 @@ class RFBClient(Protocol, TimeoutMixin):
                          redshift=0, greenshift=8, blueshift=16):
         pixformat = pack("!BBBBHHHBBBxxx", bpp, depth, bigendian, truecolor, redmax, greenmax, bluemax, redshift,
                          greenshift, blueshift)
-        self.transport.write(pack("!Bxxx16s", 0, pixformat))
+        self._send(pack("!Bxxx16s", 0, pixformat))
+        if self.capture is not None:
+            self.capture.set_pixel_format(pixformat)
         # rember these settings
         self.bpp, self.depth, self.bigendian, self.truecolor = bpp, depth, bigendian, truecolor
         self.redmax, self.greenmax, self.bluemax = redmax, greenmax, bluemax
@@ -532,9 +1091,7 @@ class RFBClient(Protocol, TimeoutMixin):
         # ~ print self.bypp
 
     def set_encodings(self, list_of_encodings):
-        self.transport.write(pack("!BxH", 2, len(list_of_encodings)))
-        for encoding in list_of_encodings:
-            self.transport.write(pack("!I", encoding))
+        self._send(pack("!BxH%dI" % len(list_of_encodings), 2, len(list_of_encodings), *list_of_encodings))
 
     def framebuffer_update_request(self, x=0, y=0, width=None, height=None, incremental=0):
         if width is None:
@@ -543,25 +1100,76 @@ class RFBClient(Protocol, TimeoutMixin):
         if height is None:
             height = self.height - y
 
-        self.transport.write(pack("!BBHHHH", 3, incremental, x, y, width, height))
+        self._send(pack("!BBHHHH", 3, incremental, x, y, width, height))
+        if self.metrics is not None:
+            self.metrics.request_sent()
+
+    def enable_continuous_updates(self, enable=1, x=0, y=0, width=None, height=None):
+        """Ask the server to push updates of the area without requests, or to stop.
+           Only valid after the server sent an EndOfContinuousUpdates message."""
+        if width is None:
+            width = self.width - x
+
+        if height is None:
+            height = self.height - y
+
+        self._send(pack("!BBHHHH", 150, enable, x, y, width, height))
+        self.continuous_updates = bool(enable)
+
+    def send_fence(self, flags, payload=b""):
+        """Only valid after the server sent a Fence message."""
+        self._send(pack("!BxxxIB", 248, flags, len(payload)) + payload)
 
     def key_event(self, key, down=1):
         """For most ordinary keys, the "keysym" is the same as the corresponding ASCII value.
         Other common keys are shown in the KEY_ constants."""
-        self.transport.write(pack("!BBxxI", 4, down, key))
+        self._send(pack("!BBxxI", 4, down, key))
+
+    def key_events(self, messages):
+        """Sends KeyEvent messages encoded by key_event_messages."""
+        self._send(messages)
 
     def pointer_event(self, x, y, buttonmask=0):
         """Indicates either pointer movement or a pointer button press or release. The pointer is
            now at (x-position, y-position), and the current state of buttons 1 to 8 are represented
            by bits 0 to 7 of button-mask respectively, 0 meaning up, 1 meaning down (pressed).
         """
-        self.transport.write(pack("!BBHH", 5, buttonmask, x, y))
+        self._send(pack("!BBHH", 5, buttonmask, x, y))
 
     def client_cut_text(self, message):
         """The client has new ASCII text in its cut buffer.
            (aka clipboard)
         """
-        self.transport.write(pack("!BxxxI", 6, len(message)) + message)
+        self._send(pack("!BxxxI", 6, len(message)) + message)
+
+    def _send(self, data):
+        """queue a message, may be called from any thread. the messages queued until the
+           next reactor iteration are written at once"""
+        with self._outgoing_lock:
+            self._outgoing.append(data)
+            if self._flush_scheduled:
+                return
+            self._flush_scheduled = True
+        self.schedule_flush(self._flush)
+
+    def schedule_flush(self, flush):
+        """call flush in the thread of the event loop, override for other event loops"""
+        if threadable.isInIOThread():
+            reactor.callLater(0, flush)
+        else:
+            reactor.callFromThread(flush)
+
+    def call_later(self, delay, function, *args):
+        """call function after delay seconds in the thread of the event loop, returns a handle
+           with cancel(). override for other event loops"""
+        return reactor.callLater(delay, function, *args)
+
+    def _flush(self):
+        with self._outgoing_lock:
+            outgoing, self._outgoing = self._outgoing, []
+            self._flush_scheduled = False
+        if outgoing:
+            self.transport.write(b"".join(outgoing))
 
     # ------------------------------------------------------
     # callbacks
@@ -571,6 +1179,16 @@ class RFBClient(Protocol, TimeoutMixin):
         """connection is initialized and ready.
            typicaly, the pixel format is set here."""
 
+    def end_of_continuous_updates(self):
+        """the server supports continuous updates, or it stopped pushing them"""
+        self.continuous_updates = False
+
+    def fence(self, flags, payload):
+        """the server sent a fence. messages are handled and sent in order,
+           so a requested fence is answered at once with the flags that apply"""
+        if flags & FENCE_REQUEST:
+            self.send_fence(flags & (FENCE_BLOCK_BEFORE | FENCE_BLOCK_AFTER | FENCE_SYNC_NEXT), payload)
+
     def vnc_request_password(self):
         """a password is needed to log on, use sendPassword() to
            send one."""
@@ -598,8 +1216,8 @@ class RFBClient(Protocol, TimeoutMixin):
            rectangles."""
 
     def update_rectangle(self, x, y, width, height, data):
-        """new bitmap data. data is a string in the pixel format set
-           up earlier."""
+        """new bitmap data. data is a bytes-like object in the pixel
+           format set up earlier."""
 
     def copy_rectangle(self, srcx, srcy, x, y, width, height):
         """used for copyrect encoding. copy the given rectangle
@@ -610,7 +1228,20 @@ class RFBClient(Protocol, TimeoutMixin):
            the pixel format set up earlier"""
         # fallback variant, use update recatngle
         # override with specialized function for better performance
-        self.update_rectangle(x, y, width, height, color * width * height)
+        self.update_rectangle(x, y, width, height, bytes(color) * width * height)
+
+    def fill_rectangles(self, rectangles, colors):
+        """fill many areas at once. rectangles is an array of (x, y, width, height)
+           rows, colors an array with the pixel of each rectangle. later rectangles
+           paint over earlier ones."""
+        # fallback variant, use fill rectangle
+        # override with a vectorized function for better performance
+        for (x, y, width, height), color in zip(rectangles.tolist(), colors):
+            self.fill_rectangle(x, y, width, height, color.tobytes())
+
+    def set_colour_map_entries(self, first, colours):
+        """the server set the colour map entries from first on, colours is a (n, 3) array
+           of 16 bit red, green, blue values. only used by colour map pixel formats"""
 
     def bell(self):
         """bell"""
@@ -620,6 +1251,45 @@ class RFBClient(Protocol, TimeoutMixin):
            (aka clipboard)"""
 
 
+def key_event_messages(keys):
+    """KeyEvent messages that press and release each keysym in turn, as one buffer"""
+    messages = np.zeros(2 * len(keys), dtype=KEY_EVENT_DTYPE)
+    messages["type"] = 4
+    messages["down"][0::2] = 1
+    messages["key"] = np.repeat(np.asarray(keys, dtype=np.uint32), 2)
+    return messages.tobytes()
+
+
+def unpack_bits(packed, bits):
+    """split every byte of a (rows x bytes) array into 8 / bits big endian values of width bits"""
+    values = np.unpackbits(packed, axis=1)
+    if bits == 1:
+        return values
+    values = values.reshape(len(packed), -1, bits)
+    return values.dot(1 << np.arange(bits - 1, -1, -1)).astype(np.uint8)
+
+
+def concat_ranges(starts, counts, step=1):
+    """concatenation of range(start, start + count * step, step) for all start, count pairs"""
+    counts = np.asarray(counts)
+    first = np.cumsum(counts) - counts
+    return np.repeat(np.asarray(starts) - first * step, counts) + np.arange(counts.sum()) * step
+
+
+def gradient_decode(diff, maxes):
+    """undo the tight gradient filter, diff is a (height, width, 3) array of prediction errors.
+       every pixel depends on its left and upper neighbours, so the anti diagonals are
+       reconstructed one after another, each one in a single vectorized step."""
+    height, width = diff.shape[:2]
+    values = np.zeros((height + 1, width + 1, 3), np.int32)  # padded with a zero row and column
+    for d in range(height + width - 1):
+        i = np.arange(max(0, d - width + 1), min(height, d + 1))
+        j = d - i
+        predicted = np.clip(values[i, j + 1] + values[i + 1, j] - values[i, j], 0, maxes)
+        values[i + 1, j + 1] = (predicted + diff[i, j]) & maxes
+    return values[1:, 1:]
+
+
 class RFBFactory(protocol.ClientFactory):
     """A factory for remote frame buffer connections."""
 
@@ -627,6 +1297,33 @@ class RFBFactory(protocol.ClientFactory):
     # should be overriden by application to use a derrived class
     protocol = RFBClient
 
+    # object with a write(data) method that captures the server -> client stream, see ReplayServer.StreamCapture
+    capture = None
+
+    # collect Metrics on every connection
+    metrics = False
+
+    # incremental update requests kept outstanding
+    pipeline = 1
+
+    # offer the ContinuousUpdates and Fence pseudo-encodings and use them when the server supports them
+    continuous_updates = False
+
+    # upper limit of the update rate, None requests the next update as soon as one is complete
+    max_fps = None
+
+    # request updates only when the application asks for one
+    on_demand = False
+
+    # keep the pixel format of the server instead of asking for 32 bit RGBX
+    native_format = False
+
+    # (x, y, width, height) the incremental requests cover, the whole screen when empty
+    regions = ()
+
+    # seconds between incremental requests of the whole screen while there are regions
+    full_refresh = 10.0
+
     def __init__(self, password=None, shared=0):
         self.password = password
         self.shared = shared
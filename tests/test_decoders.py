@@ -0,0 +1,344 @@
+"""
+Decoder tests for Tight, ZRLE and ZlibHex.
+
+Hand-built rectangles are fed through RFBToGUI.dataReceived into a headless ArrayBuffer, once
+whole and once in small chunks, and the framebuffer is compared with the expected pixels.
+
+usage: python -m pytest tests
+"""
+import io
+import os
+import struct
+import zlib
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import numpy as np
+import pygame
+import pytest
+from pyVNC import rfb
+from pyVNC.Buffer import ArrayBuffer
+from pyVNC.RFBToGUI import RFBToGUI
+from pyVNC.VNCFactory import VNCFactory
+
+# 32 bit RGBX, little endian: a pixel is the bytes red, green, blue, padding
+PIXEL_FORMAT = struct.pack("!BBBBHHHBBBxxx", 32, 24, 0, 1, 255, 255, 255, 0, 8, 16)
+
+# None feeds every update whole, a number feeds it in pieces of 1 to that many bytes
+SPLITS = [None, 1, 3, 7]
+
+
+class NullTransport:
+    def write(self, data):
+        pass
+
+    def writeSequence(self, data):
+        pass
+
+    def loseConnection(self):
+        raise AssertionError("the client dropped the connection")
+
+
+def connect(width, height):
+    """an RFBToGUI after the handshake with a width x height RGBX screen"""
+    protocol = RFBToGUI()
+    protocol.factory = VNCFactory(ArrayBuffer(), 32, False, None, 1)
+    protocol.makeConnection(NullTransport())
+    protocol.dataReceived(b"RFB 003.003\n")
+    protocol.dataReceived(struct.pack("!I", 1))
+    protocol.dataReceived(struct.pack("!HH16sI", width, height, PIXEL_FORMAT, 4) + b"test")
+    return protocol
+
+
+def feed(protocol, data, split, seed=0):
+    if split is None:
+        protocol.dataReceived(data)
+        return
+    rng = np.random.default_rng(seed)
+    pos = 0
+    while pos < len(data):
+        end = pos + int(rng.integers(1, split + 1))
+        protocol.dataReceived(data[pos:end])
+        pos = end
+
+
+def decode(width, height, rectangles, split):
+    """the framebuffer after one update of the rectangles"""
+    protocol = connect(width, height)
+    feed(protocol, struct.pack("!BxH", 0, len(rectangles)) + b"".join(rectangles), split)
+    return protocol.framebuffer
+
+
+def header(x, y, width, height, encoding):
+    return struct.pack("!HHHHi", x, y, width, height, encoding)
+
+
+def screen(width, height, colors=None, seed=0):
+    """random RGBX pixels, drawn from colors if given"""
+    rng = np.random.default_rng(seed)
+    if colors is None:
+        pixels = np.zeros(shape=(height, width, 4), dtype=np.uint8)
+        pixels[..., :3] = rng.integers(0, 256, (height, width, 3))
+        return pixels
+    return colors[rng.integers(0, len(colors), (height, width))]
+
+
+def palette(count, seed=1):
+    colors = np.zeros(shape=(count, 4), dtype=np.uint8)
+    colors[:, :3] = np.random.default_rng(seed).choice(1 << 24, count, replace=False)[:, None] >> [0, 8, 16] & 255
+    return colors
+
+
+def indices_of(pixels, colors):
+    return (pixels[..., None, :] == colors).all(axis=-1).argmax(axis=-1).astype(np.uint8)
+
+
+def pack_bits(indices, bits):
+    """rows of palette indices packed most significant bits first, rows padded to whole bytes"""
+    per_byte = 8 // bits
+    height, width = indices.shape
+    padded = np.zeros(shape=(height, -(-width // per_byte) * per_byte), dtype=np.uint8)
+    padded[:, :width] = indices
+    shifts = (bits * np.arange(per_byte - 1, -1, -1)).astype(np.uint8)
+    return np.bitwise_or.reduce(padded.reshape(height, -1, per_byte) << shifts, axis=2).astype(np.uint8).tobytes()
+
+
+def compressed(stream, data):
+    return stream.compress(data) + stream.flush(zlib.Z_SYNC_FLUSH)
+
+
+# --- Tight
+
+def compact_length(length):
+    encoded = bytes([length & 0x7f | (0x80 if length > 0x7f else 0)])
+    if length > 0x7f:
+        encoded += bytes([length >> 7 & 0x7f | (0x80 if length > 0x3fff else 0)])
+    if length > 0x3fff:
+        encoded += bytes([length >> 14])
+    return encoded
+
+
+def tight_data(stream, data):
+    """data below 12 bytes is sent as is, longer data compressed with a compact length"""
+    if len(data) < 12:
+        return data
+    data = compressed(stream, data)
+    return compact_length(len(data)) + data
+
+
+def tight_palette(x, y, pixels, colors, stream):
+    """palette filter rectangle on stream 1"""
+    height, width = pixels.shape[:2]
+    indices = indices_of(pixels, colors)
+    data = pack_bits(indices, 1) if len(colors) == 2 else indices.tobytes()
+    return (header(x, y, width, height, rfb.TIGHT_ENCODING) + b"\x50\x01" + bytes([len(colors) - 1]) +
+            colors[:, :3].tobytes() + tight_data(stream, data))
+
+
+def gradient_encode(rgb):
+    values = np.zeros(shape=(rgb.shape[0] + 1, rgb.shape[1] + 1, 3), dtype=np.int32)
+    values[1:, 1:] = rgb
+    predicted = np.clip(values[:-1, 1:] + values[1:, :-1] - values[:-1, :-1], 0, 255)
+    return ((values[1:, 1:] - predicted) & 255).astype(np.uint8)
+
+
+@pytest.mark.parametrize("split", SPLITS)
+def test_tight_fill_copy_and_palette(split):
+    streams = [zlib.compressobj(6) for _ in range(4)]
+    expected = np.zeros(shape=(40, 72, 4), dtype=np.uint8)
+    rectangles = []
+
+    expected[:8, :8, :3] = (10, 20, 30)
+    rectangles.append(header(0, 0, 8, 8, rfb.TIGHT_ENCODING) + b"\x80" + bytes([10, 20, 30]))
+
+    expected[:1, 8:11] = screen(3, 1)  # 9 bytes, sent uncompressed
+    rectangles.append(header(8, 0, 3, 1, rfb.TIGHT_ENCODING) + b"\x00" + expected[:1, 8:11, :3].tobytes())
+
+    expected[8:24, :32] = screen(32, 16, seed=2)
+    rectangles.append(header(0, 8, 32, 16, rfb.TIGHT_ENCODING) + b"\x00" +
+                      tight_data(streams[0], expected[8:24, :32, :3].tobytes()))
+
+    for x, count, width in ((32, 2, 13), (48, 2, 4), (56, 5, 16), (0, 16, 2)):
+        colors = palette(count, seed=count)
+        expected[24:40, x:x + width] = screen(width, 16, colors, seed=x)
+        rectangles.append(tight_palette(x, 24, expected[24:40, x:x + width], colors, streams[1]))
+
+    # the palette rectangle of 2 x 1 pixels has one byte of indices
+    colors = palette(2, seed=9)
+    expected[2:3, 64:66] = colors
+    rectangles.append(tight_palette(64, 2, expected[2:3, 64:66], colors, streams[1]))
+
+    assert (decode(72, 40, rectangles, split) == expected).all()
+
+
+@pytest.mark.parametrize("split", SPLITS)
+def test_tight_gradient(split):
+    stream = zlib.compressobj(6)
+    gy, gx = np.mgrid[0:30, 0:50]
+    expected = np.zeros(shape=(30, 50, 4), dtype=np.uint8)
+    expected[..., :3] = np.stack([gx * 5, gy * 8, gx + gy], axis=2)
+    expected[10:20, 10:20, :3] = screen(10, 10, seed=3)[..., :3]  # prediction errors that wrap around
+    data = gradient_encode(expected[..., :3]).tobytes()
+    rectangle = header(0, 0, 50, 30, rfb.TIGHT_ENCODING) + b"\x60\x02" + tight_data(stream, data)
+    assert (decode(50, 30, [rectangle], split) == expected).all()
+
+
+@pytest.mark.parametrize("split", SPLITS)
+def test_tight_jpeg(split):
+    gy, gx = np.mgrid[0:24, 0:40]
+    rgb = np.stack([gx * 6, gy * 10, 255 - gx * 6], axis=2).astype(np.uint8)
+    out = io.BytesIO()
+    pygame.image.save(pygame.image.frombuffer(rgb.tobytes(), (40, 24), "RGB"), out, "rect.jpg")
+    data = out.getvalue()
+    expected = np.zeros(shape=(24, 48, 4), dtype=np.uint8)
+    image = pygame.image.load(io.BytesIO(data), "rect.jpg")
+    expected[:, 8:, :3] = np.frombuffer(pygame.image.tostring(image, "RGB"), np.uint8).reshape(24, 40, 3)
+    rectangle = header(8, 0, 40, 24, rfb.TIGHT_ENCODING) + b"\x90" + compact_length(len(data)) + data
+    assert (decode(48, 24, [rectangle], split) == expected).all()
+
+
+def stored_palette_rectangle(length):
+    """a palette rectangle whose compressed data is exactly length bytes long,
+       compression level 0 adds a fixed number of bytes to the indices"""
+    overhead = len(compressed(zlib.compressobj(0), bytes(100))) - 100
+    width = length - overhead
+    colors = palette(3)
+    pixels = screen(width, 1, colors)
+    data = compressed(zlib.compressobj(0), indices_of(pixels, colors).tobytes())
+    assert len(data) == length
+    return pixels, (header(0, 0, width, 1, rfb.TIGHT_ENCODING) + b"\x50\x01\x02" + colors[:, :3].tobytes() +
+                    compact_length(length) + data)
+
+
+@pytest.mark.parametrize("split", [None, 5])
+@pytest.mark.parametrize("length, size", [(0x7f, 1), (0x80, 2), (0x3fff, 2), (0x4000, 3)])
+def test_tight_compact_length(length, size, split):
+    pixels, rectangle = stored_palette_rectangle(length)
+    assert len(compact_length(length)) == size
+    expected = np.zeros(shape=(1, pixels.shape[1], 4), dtype=np.uint8)
+    expected[:] = pixels
+    assert (decode(pixels.shape[1], 1, [rectangle], split) == expected).all()
+
+
+# --- ZRLE
+
+def rle_length(length):
+    return b"\xff" * ((length - 1) // 255) + bytes([(length - 1) % 255])
+
+
+def runs_of(values):
+    """(start, length) of the runs of equal values"""
+    starts = np.flatnonzero(np.diff(values.astype(np.int32), prepend=-1))
+    return zip(starts.tolist(), np.diff(np.append(starts, len(values))).tolist())
+
+
+def zrle_tile(pixels, kind, colors):
+    if kind == "raw":
+        return b"\x00" + pixels[..., :3].tobytes()
+    if kind == "solid":
+        return b"\x01" + pixels[0, 0, :3].tobytes()
+    indices = indices_of(pixels, colors)
+    cpixels = colors[:, :3].tobytes()
+    if kind == "packed":
+        bits = 1 if len(colors) == 2 else 2 if len(colors) <= 4 else 4
+        return bytes([len(colors)]) + cpixels + pack_bits(indices, bits)
+    flat = indices.ravel()
+    if kind == "rle":
+        return b"\x80" + b"".join(colors[flat[start], :3].tobytes() + rle_length(length)
+                                  for start, length in runs_of(flat))
+    body = b"".join(bytes([flat[start]]) if length == 1 else bytes([flat[start] | 128]) + rle_length(length)
+                    for start, length in runs_of(flat))
+    return bytes([128 + len(colors)]) + cpixels + body
+
+
+def zrle_pixels(width, height, kind, colors, seed):
+    if kind == "raw":
+        return screen(width, height, seed=seed)
+    if kind == "solid":
+        return screen(width, height, colors[:1])
+    if kind == "packed":
+        return screen(width, height, colors, seed=seed)
+    # runs of 1 to 600 pixels, longer than a row and long enough for several 255 bytes
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(1, 600, width * height)
+    values = np.repeat(rng.integers(0, len(colors), len(lengths)), lengths)[:width * height]
+    return colors[values].reshape(height, width, 4)
+
+
+@pytest.mark.parametrize("split", SPLITS)
+def test_zrle(split):
+    width, height = 150, 100  # tiles of 64x64, 22x64, 64x36 and 22x36 at the edges
+    kinds = [("raw", 0), ("solid", 1), ("packed", 2), ("packed", 3), ("packed", 16), ("rle", 5),
+             ("palette rle", 2), ("palette rle", 7), ("palette rle", 127)]
+    expected = np.zeros(shape=(height, width, 4), dtype=np.uint8)
+    body = []
+    for number, (y, x) in enumerate((y, x) for y in range(0, height, 64) for x in range(0, width, 64)):
+        kind, count = kinds[number % len(kinds)]
+        h, w = min(64, height - y), min(64, width - x)
+        colors = palette(max(count, 1), seed=number)
+        expected[y:y + h, x:x + w] = zrle_pixels(w, h, kind, colors, number)
+        body.append(zrle_tile(expected[y:y + h, x:x + w], kind, colors))
+    data = compressed(zlib.compressobj(6), b"".join(body))
+    rectangle = header(0, 0, width, height, rfb.ZRLE_ENCODING) + struct.pack("!I", len(data)) + data
+    assert (decode(width, height, [rectangle], split) == expected).all()
+
+
+@pytest.mark.parametrize("kind, count", [("rle", 4), ("palette rle", 3), ("palette rle", 127), ("packed", 4)])
+@pytest.mark.parametrize("split", SPLITS)
+def test_zrle_tile_kinds(kind, count, split):
+    """one kind on every tile, with the zlib stream carried over to the second rectangle"""
+    stream = zlib.compressobj(6)
+    expected = np.zeros(shape=(70, 130, 4), dtype=np.uint8)
+    rectangles = []
+    for x, y, width, height in ((0, 0, 130, 64), (0, 64, 130, 6)):
+        body = []
+        for tx in range(x, x + width, 64):
+            w = min(64, x + width - tx)
+            colors = palette(count, seed=tx)
+            expected[y:y + height, tx:tx + w] = zrle_pixels(w, height, kind, colors, tx + y)
+            body.append(zrle_tile(expected[y:y + height, tx:tx + w], kind, colors))
+        data = compressed(stream, b"".join(body))
+        rectangles.append(header(x, y, width, height, rfb.ZRLE_ENCODING) + struct.pack("!I", len(data)) + data)
+    assert (decode(130, 70, rectangles, split) == expected).all()
+
+
+# --- ZlibHex
+
+@pytest.mark.parametrize("split", SPLITS)
+def test_zlibhex(split):
+    """raw, zlib raw, zlib compressed and plain hextile tiles, the colors carried from tile to tile"""
+    width, height = 56, 40
+    raw_stream, stream = zlib.compressobj(6), zlib.compressobj(6)
+    expected = np.zeros(shape=(height, width, 4), dtype=np.uint8)
+    bg, fg = palette(2, seed=5)
+    body = []
+    for number, (y, x) in enumerate((y, x) for y in range(0, height, 16) for x in range(0, width, 16)):
+        h, w = min(16, height - y), min(16, width - x)
+        tile = expected[y:y + h, x:x + w]
+        kind = number % 5
+        if kind < 2:
+            tile[:] = screen(w, h, seed=number)
+            if kind == 0:
+                body.append(b"\x01" + tile.tobytes())
+            else:
+                data = compressed(raw_stream, tile.tobytes())
+                body.append(b"\x20" + struct.pack("!H", len(data)) + data)
+            continue
+        # background, foreground and two subrects, the background of the last tile when kind is 4
+        tile[:] = bg
+        tile[1:3, 2:5] = fg
+        tile[h - 2:h, w - 1:w] = fg
+        subrects = bytes([2 << 4 | 1, 2 << 4 | 1, (w - 1) << 4 | (h - 2), 0 << 4 | 1])
+        if kind == 4:
+            data = bytes([2]) + subrects
+            subencoding = 8
+        else:
+            data = bg.tobytes() + fg.tobytes() + bytes([2]) + subrects
+            subencoding = 2 | 4 | 8
+        if kind == 2:
+            data = compressed(stream, data)
+            body.append(bytes([subencoding | 64]) + struct.pack("!H", len(data)) + data)
+        else:
+            body.append(bytes([subencoding]) + data)
+    rectangle = header(0, 0, width, height, rfb.ZLIBHEX_ENCODING) + b"".join(body)
+    assert (decode(width, height, [rectangle], split) == expected).all()